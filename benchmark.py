@@ -0,0 +1,157 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import resource
+import tracemalloc
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+# Reproducible benchmark scenarios for the simulation. Each scenario runs in
+# its own process so import-time work, caches and peak memory don't leak from
+# one scenario into the next. Results are printed as a JSON list.
+
+SCENARIOS = {
+    'baseline':      {},
+    'baseline_store': {'vectorized': True},
+    'chickens_50':   {'chicken_count': 50},
+    'chickens_500':  {'chicken_count': 500},
+    'chickens_5000': {'chicken_count': 5000},
+    'chickens_5000_sharded': {'chicken_count': 5000, 'workers': 4},
+    'chickens_5000_no_lod': {'chicken_count': 5000, 'lod': False},
+    'chickens_spawned_live': {'spawn_per_tick': 5},  # starts small, like the game, and grows
+    'pigs_10':       {'pig_count': 10},
+    'pigs_100':      {'pig_count': 100},
+    'day':           {'night': False},
+    'night':         {'night': True},
+    'mass_attack':   {'mass_attack': 200},
+    'dirty_rects':   {'dirty_rects': True},
+}
+
+# Surround the character with chickens so every swing lands on something
+def crowd_character(world, count):
+    import game
+    character = world.character
+    placed = 0
+    for _ in range(count * 20):
+        if placed == count:
+            break
+        x = int(character.x) + random.randint(-6, 6) * game.TILE_SIZE
+        y = int(character.y) + random.randint(-6, 6) * game.TILE_SIZE
+        if world.spawn('chicken', x, y):
+            placed += 1
+    return placed
+
+def run_scenario(name, ticks, seed, render, memory):
+    os.environ['SDL_VIDEODRIVER'] = 'dummy'
+    # SDL turns SIGTERM into a quit event, which would leave the pool unable
+    # to stop this worker
+    os.environ['SDL_NO_SIGNAL_HANDLERS'] = '1'
+    options = dict(SCENARIOS[name])
+    night = options.pop('night', False)
+    mass_attack = options.pop('mass_attack', 0)
+    dirty_rects = options.pop('dirty_rects', False)
+    spawn_per_tick = options.pop('spawn_per_tick', 0)
+
+    if memory:
+        tracemalloc.start()
+    import_start = time.perf_counter()
+    import game
+    import_seconds = time.perf_counter() - import_start
+
+    random.seed(seed)
+    game.pygame.init()
+    screen = game.pygame.display.set_mode((game.SCREEN_WIDTH, game.SCREEN_HEIGHT))
+    font = game.pygame.font.Font(None, 36)
+
+    profiler = game.Profiler()
+    world = game.World(profiler=profiler, **options)
+    if mass_attack:
+        crowd_character(world, mass_attack)
+    if night:
+        world.game_time = game.DAY_DURATION + game.TRANSITION_DURATION
+    renderer = game.DirtyRectRenderer() if dirty_rects else None
+    setup = dict(profiler.totals)
+    profiler.reset()
+
+    start_time = time.perf_counter()
+    for _ in range(ticks):
+        profiler.start()
+        if mass_attack:
+            character = world.character
+            if not character.attacking:
+                character.direction = (character.direction + 1) % 4
+                character.attack()
+        if spawn_per_tick:
+            world.spawn_random('chicken', spawn_per_tick)
+            profiler.lap('spawn')
+        game_time = world.game_time
+        world.step()
+        if render and renderer is not None:
+            renderer.draw(screen, font, world, game_time)
+        elif render:
+            game.draw_world(screen, font, world, game_time)
+            game.pygame.display.flip()
+            profiler.lap('flip')
+    seconds = time.perf_counter() - start_time
+
+    result = {
+        'scenario': name,
+        'seed': seed,
+        'ticks': ticks,
+        'vectorized': world.store is not None,
+        'workers': options.get('workers', 0),
+        'import_ms': round(import_seconds * 1000, 3),
+        'setup_ms': {phase: round(total * 1000, 3) for phase, total in setup.items()},
+        'asset_ms': {filename: round(seconds * 1000, 3) for filename, seconds in game.assets.timings.items()},
+        'phase_ms_per_tick': {phase: round(total * 1000 / ticks, 4) for phase, total in sorted(profiler.totals.items())},
+        'seconds': round(seconds, 3),
+        'fps': round(ticks / seconds, 2),
+        'summary': world.summary(),
+        # ru_maxrss is KiB on Linux and bytes on macOS
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // (1024 if sys.platform == 'darwin' else 1),
+    }
+    if memory:
+        result['tracemalloc_peak_kb'] = tracemalloc.get_traced_memory()[1] // 1024
+        tracemalloc.stop()
+    world.close()
+    game.pygame.quit()
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="Barnyard Chaos benchmarks")
+    parser.add_argument('scenarios', nargs='*', default=list(SCENARIOS), help="scenarios to run (default: all)")
+    parser.add_argument('--ticks', type=int, default=600, help="simulation ticks per scenario")
+    parser.add_argument('--seed', type=int, default=1, help="random seed")
+    parser.add_argument('--no-render', dest='render', action='store_false', help="skip drawing to the dummy display")
+    parser.add_argument('--memory', action='store_true', help="track peak Python allocations with tracemalloc (slow)")
+    parser.add_argument('--output', help="write the JSON results to a file instead of stdout")
+    args = parser.parse_args()
+
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error(f"unknown scenario {name!r}, expected one of: {', '.join(SCENARIOS)}")
+
+    # game.py loads its assets relative to the working directory
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    # Executor workers aren't daemons, so sharded scenarios can start their
+    # own process pool
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for name in args.scenarios:
+        with ProcessPoolExecutor(1, mp_context=context) as executor:
+            result = executor.submit(run_scenario, name, args.ticks, args.seed, args.render, args.memory).result()
+        print(f"{name}: {result['fps']} fps", file=sys.stderr)
+        results.append(result)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+if __name__ == '__main__':
+    main()
@@ -1,105 +1,1218 @@
 import os
+import sys
 import pygame
 import csv
 import random
-import requests
 import json
 import heapq
-
-# Initialize Pygame
-pygame.init()
+import time
+import threading
+import argparse
+import multiprocessing
+import hashlib
+import socket
+import mmap
+import struct
+import base64
+import zlib
+import gzip
+import xml.etree.ElementTree as ET
+from array import array
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from multiprocessing import shared_memory
+
+try:
+    import numpy as np
+except ImportError:  # NumPy is optional; without it NPCs are updated one at a time
+    np = None
 
 # Constants
 TILE_SIZE = 32  # 16 * 2
 SCREEN_WIDTH = 1600
 SCREEN_HEIGHT = 1200
-MAP_WIDTH = 100  # Width of the map in tiles
-MAP_HEIGHT = 80  # Height of the map in tiles
+MAP_FILENAME = 'map1.tmx'
+MAP_CHUNK_TILES = 16  # Width and height of a map render chunk in tiles
+MAP_CHUNK_CACHE_BYTES = 64 * 1024 * 1024  # Memory cap for rendered map chunks
 WATER_TILE_ID = 283
 DEFAULT_TILE_ID = 405
 WALKABLE_TILE_IDS = [405, 365, 1201, 532, 326, 286, 246, 0]  # List of walkable tile IDs
 BLOOD_SPLAT_FADE_DURATION = 1800  # Frames for 30 seconds at 60 FPS
+DECAL_CAPACITY = 256  # Fading decals drawn over the map before the oldest is baked early
+DECAL_FADE_STEPS = 16  # Distinct alpha levels while a decal fades
+DECAL_SETTLED_ALPHA = 144  # Alpha a decal fades to and is baked into the map with
+DECAL_CHUNK_LIMIT = 128  # Baked decals replayed when a map chunk is rebuilt; see Map.bake_decal
 CHICKEN_SPAWN_TILE_ID = 293
+TMX_GID_MASK = 0x1FFFFFFF  # Strips Tiled's flip/rotation flags from a gid
+MAP_CACHE_MAGIC = b'BYC' + (b'L' if sys.byteorder == 'little' else b'B')
+MAP_CACHE_HEADER = struct.Struct('=4sqIII')  # magic, source mtime_ns, width, height, metadata size
+PIG_CHASE_RADIUS = 200  # Pixels within which a pig notices a chicken
+NPC_ANIMATION_SPEED = 10  # Frames between NPC animation steps
+NPC_MAX_FLEE_TIME = 60  # Frames an NPC keeps fleeing after being hit
+VECTORIZE_MIN_ANIMALS = 300  # Animals from which World steps them in bulk; below it the per-object loop is faster
+
+# Level of detail for NPC updates, by distance from the camera's view
+LOD_NEAR_MARGIN = 256  # Pixels beyond the view within which NPCs tick every frame
+LOD_MID_MARGIN = 768  # Pixels beyond the view within which NPCs tick every LOD_MID_INTERVAL frames
+LOD_MID_INTERVAL = 4
+LOD_FAR_INTERVAL = 16  # Everyone further away; keeps a wander step within half a tile
+# Far NPCs also skip collisions with each other
+
+# Pathfinding constants
+PATH_CACHE_SIZE = 512  # Paths kept in the LRU cache
+PATH_NODE_BUDGET = 1500  # Node expansions shared by all path requests per frame
+PATH_MAX_EXPANSIONS = 20000  # Give up on a single search after this many expansions
+SQRT_2 = 2 ** 0.5
 
 # Day/night cycle constants
 DAY_DURATION = 20 * 60  # 5 real-time minutes (300 seconds)
 NIGHT_COLOR = (0, 0, 50)  # Dark blue color for night
 TRANSITION_DURATION = 120  # Transition duration for sunset/sunrise (1 second)
 
-# Load images
-tileset = pygame.image.load('Overworld.png')
-blood_puddle_image = pygame.image.load('blood_puddle.png')
-character_tileset = pygame.image.load('character.png')
-character_sword = pygame.image.load('character_sword.png')
-blood_splat_tileset = pygame.image.load('blood_hit.png')
-cow_tileset = pygame.image.load('cow_walk.png')
-chicken_tileset = pygame.image.load('chicken_walk.png')
-pig_tileset = pygame.image.load('pig_walk.png')
-wizard_tileset = pygame.image.load('wizard.png')  # Load wizard tileset
+# Asset files
+TILESET_FILENAME = 'Overworld.png'
+BLOOD_PUDDLE_FILENAME = 'blood_puddle.png'
+BLOOD_SPLAT_FILENAME = 'blood_hit.png'
+CHARACTER_FILENAME = 'character.png'
+CHARACTER_SWORD_FILENAME = 'character_sword.png'
+WIZARD_FILENAME = 'wizard.png'
+DIALOG_TREE_FILENAME = 'dialog_tree.json'
+ASSET_LOAD_THREADS = 4
+
+# Images and the default dialog tree, loaded on first use rather than at
+# import. load_all() decodes every image up front on a thread pool (SDL's
+# image decoding runs without the GIL) while the caller shows progress.
+# timings records the seconds spent loading each file.
+class AssetManager:
+    def __init__(self):
+        self.images = {}  # filename -> Surface
+        self.dialog_trees = {}  # filename -> DialogGraph
+        self.timings = {}  # filename -> seconds
+        self.lock = threading.Lock()  # guards locks
+        self.locks = {}  # filename -> Lock held while that file loads
+
+    def load_image(self, filename):
+        start_time = time.perf_counter()
+        image = pygame.image.load(filename)
+        self.timings[filename] = time.perf_counter() - start_time
+        return image
+
+    def image(self, filename):
+        image = self.images.get(filename)
+        if image is None:
+            # Each file is decoded once, and different files in parallel
+            with self.lock:
+                file_lock = self.locks.setdefault(filename, threading.Lock())
+            with file_lock:
+                image = self.images.get(filename)
+                if image is None:
+                    image = self.images[filename] = self.load_image(filename)
+        return image
+
+    def dialog_tree(self, filename=DIALOG_TREE_FILENAME):
+        if filename not in self.dialog_trees:
+            start_time = time.perf_counter()
+            self.dialog_trees[filename] = load_dialog_tree(filename)
+            self.timings[filename] = time.perf_counter() - start_time
+        return self.dialog_trees[filename]
+
+    # Load every image and the dialog tree, calling progress(done, total,
+    # filename) on this thread as each one finishes
+    def load_all(self, progress=None, threads=ASSET_LOAD_THREADS):
+        filenames = [filename for filename in asset_images() if filename not in self.images]
+        total = len(filenames) + 1
+        with ThreadPoolExecutor(threads) as executor:
+            futures = {executor.submit(self.image, filename): filename for filename in filenames}
+            for done, future in enumerate(as_completed(futures), 1):
+                future.result()
+                if progress is not None:
+                    progress(done, total, futures[future])
+        self.dialog_tree()
+        if progress is not None:
+            progress(total, total, DIALOG_TREE_FILENAME)
+
+assets = AssetManager()
+
+# Every image file the game draws from
+def asset_images():
+    return ([TILESET_FILENAME, BLOOD_PUDDLE_FILENAME, BLOOD_SPLAT_FILENAME, CHARACTER_FILENAME, CHARACTER_SWORD_FILENAME, WIZARD_FILENAME] +
+            [config['tileset'] for config in SPECIES.values()])
+
+# The tileset scaled to TILE_SIZE in a single call. Tiles are handed out as
+# memoized subsurfaces; fully opaque tiles are converted to the display
+# format so they blit without per-pixel alpha.
+class TileAtlas:
+    def __init__(self, tileset, tile_size=TILE_SIZE):
+        source_tile_size = TILE_SIZE // 2
+        self.tileset = tileset
+        self.tile_size = tile_size
+        self.columns = tileset.get_width() // source_tile_size
+        self.rows = tileset.get_height() // source_tile_size
+        self.surface = pygame.transform.scale(tileset, (self.columns * tile_size, self.rows * tile_size))
+        self.converted = False
+        self.tiles = {}
+        self.opaque = {}
+        self.convert()
+
+    # Switch to the display pixel format once a display mode has been set
+    def convert(self):
+        if not self.converted and pygame.display.get_surface() is not None:
+            self.surface = self.surface.convert_alpha()
+            self.converted = True
+            self.tiles.clear()
+
+    def tile_rect(self, tile_id):
+        return pygame.Rect((tile_id % self.columns) * self.tile_size, (tile_id // self.columns) * self.tile_size, self.tile_size, self.tile_size)
+
+    def is_opaque(self, tile_id):
+        opaque = self.opaque.get(tile_id)
+        if opaque is None:
+            tile = self.surface.subsurface(self.tile_rect(tile_id))
+            opaque = self.opaque[tile_id] = pygame.mask.from_surface(tile, 254).count() == self.tile_size * self.tile_size
+        return opaque
+
+    def get(self, tile_id):
+        tile = self.tiles.get(tile_id)
+        if tile is None:
+            self.convert()
+            tile = self.surface.subsurface(self.tile_rect(tile_id))
+            if self.converted and self.is_opaque(tile_id):
+                tile = tile.convert()
+            self.tiles[tile_id] = tile
+        return tile
+
+tile_atlases = {}
+
+def get_tile_atlas(tileset):
+    atlas = tile_atlases.get(tileset)
+    if atlas is None:
+        atlas = tile_atlases[tileset] = TileAtlas(tileset)
+    return atlas
 
 # Function to get tile image from tileset
 def get_tile_image(tileset, tile_id):
-    tile_x = (tile_id % (tileset.get_width() // (TILE_SIZE // 2))) * (TILE_SIZE // 2)
-    tile_y = (tile_id // (tileset.get_width() // (TILE_SIZE // 2))) * (TILE_SIZE // 2)
-    tile_image = tileset.subsurface(pygame.Rect(tile_x, tile_y, TILE_SIZE // 2, TILE_SIZE // 2))
-    return pygame.transform.scale(tile_image, (TILE_SIZE, TILE_SIZE))
-
-# Default tile
-default_tile = get_tile_image(tileset, DEFAULT_TILE_ID)
-
+    return get_tile_atlas(tileset).get(tile_id)
+
+# Animation frames cut from a sprite sheet laid out one direction per row,
+# frame_count frames of frame_width x frame_height each, starting offset_x
+# pixels in. The sheet is scaled once (not frame by frame) and converted to
+# the display format as soon as there is a display. Every NPC of a species
+# shares the same frames table, which is updated in place on conversion.
+class SpriteFrames:
+    def __init__(self, sheet, frame_width, frame_height, frame_count, offset_x=0, scale=1):
+        self.frame_width = frame_width * scale
+        self.frame_height = frame_height * scale
+        self.frame_count = frame_count
+        self.offset_x = offset_x * scale
+        if scale != 1:
+            sheet = pygame.transform.scale(sheet, (sheet.get_width() * scale, sheet.get_height() * scale))
+        self.surface = sheet
+        self.converted = False
+        self.frames = [[], [], [], []]
+        self.cut()
+        self.convert()
+
+    def cut(self):
+        for direction, row in enumerate(self.frames):
+            row[:] = [self.surface.subsurface(pygame.Rect(self.offset_x + frame * self.frame_width, direction * self.frame_height,
+                                                          self.frame_width, self.frame_height))
+                      for frame in range(self.frame_count)]
+
+    def convert(self):
+        if not self.converted and pygame.display.get_surface() is not None:
+            self.surface = self.surface.convert_alpha()
+            self.converted = True
+            self.cut()
+
+sprite_frames = {}
+
+# Shared frames table, frames[direction][frame], for a sprite sheet layout
+def get_sprite_frames(sheet, frame_width, frame_height, frame_count, offset_x=0, scale=1):
+    key = (sheet, frame_width, frame_height, frame_count, offset_x, scale)
+    frames = sprite_frames.get(key)
+    if frames is None:
+        frames = sprite_frames[key] = SpriteFrames(sheet, frame_width, frame_height, frame_count, offset_x, scale)
+    frames.convert()
+    return frames.frames
+
+
+# Blood splats and puddles are drawn from a fixed set of pre-scaled and
+# pre-rotated images, built once and shared by every NPC, so hits and deaths
+# never scale or rotate surfaces while the game runs
+BLOOD_SPLAT_SCALE_STEPS = 8  # splat scales spread evenly over 1x..2x
+BLOOD_PUDDLE_ANGLE_STEPS = 36  # puddle rotations, 10 degrees apart
+BLOOD_PUDDLE_SCALE = .5
+
+blood_splat_animations = {}
+blood_puddle_rotations = {}
+decal_fades = {}
+
+# All scaled variants of a splat animation: a list of frame lists
+def get_blood_splat_animations(frames):
+    key = tuple(frames)
+    animations = blood_splat_animations.get(key)
+    if animations is None:
+        animations = []
+        for step in range(BLOOD_SPLAT_SCALE_STEPS):
+            scale_factor = 1 + step / (BLOOD_SPLAT_SCALE_STEPS - 1)
+            animations.append([
+                pygame.transform.scale(frame, (int(frame.get_width() * scale_factor), int(frame.get_height() * scale_factor)))
+                for frame in frames
+            ])
+        blood_splat_animations[key] = animations
+    return animations
+
+# All rotations of the puddle image at scale_factor
+def get_blood_puddle_rotations(image, scale_factor):
+    key = (image, scale_factor)
+    rotations = blood_puddle_rotations.get(key)
+    if rotations is None:
+        scaled_image = pygame.transform.scale(image, (int(image.get_width() * scale_factor), int(image.get_height() * scale_factor)))
+        rotations = blood_puddle_rotations[key] = [
+            pygame.transform.rotate(scaled_image, step * 360 / BLOOD_PUDDLE_ANGLE_STEPS)
+            for step in range(BLOOD_PUDDLE_ANGLE_STEPS)
+        ]
+    return rotations
+
+# Copies of a decal image at each DecalLayer fade step, from full opacity
+# down to DECAL_SETTLED_ALPHA
+def get_decal_fades(image):
+    fades = decal_fades.get(image)
+    if fades is None:
+        fades = decal_fades[image] = []
+        for step in range(DECAL_FADE_STEPS):
+            faded = image.copy()
+            faded.set_alpha(255 - (255 - DECAL_SETTLED_ALPHA) * step // (DECAL_FADE_STEPS - 1))
+            fades.append(faded)
+    return fades
 
 # Function to draw blood puddle
-def draw_blood_puddle(map_surface, blood_puddle_image, x, y, scale_factor, map_data):
+def draw_blood_puddle(game_map, blood_puddle_image, x, y, scale_factor):
+    x, y = int(x), int(y)
     tile_x = x // TILE_SIZE
     tile_y = y // TILE_SIZE
-    if map_data.map_data[tile_y][tile_x] in WALKABLE_TILE_IDS:  # Access map_data attribute
-        scaled_image = pygame.transform.scale(blood_puddle_image, (
-            int(blood_puddle_image.get_width() * scale_factor), int(blood_puddle_image.get_height() * scale_factor)))
-        random_angle = random.uniform(0, 360)
-        rotated_image = pygame.transform.rotate(scaled_image, random_angle)
+    if game_map.is_tile_walkable(tile_x, tile_y):
+        rotated_image = random.choice(get_blood_puddle_rotations(blood_puddle_image, scale_factor))
         offset_x = x + TILE_SIZE // 2 - rotated_image.get_width() // 2
         offset_y = y + TILE_SIZE // 2 - rotated_image.get_height() // 2
-        map_surface.blit(rotated_image, (offset_x, offset_y))
-
-
+        game_map.add_decal(rotated_image, offset_x, offset_y)
+
+
+
+# TMX/TSX map loading
+# Tiles are stored as in map.csv: the tileset-local tile ID, or -1 for an
+# empty cell. Tileset tiles may carry a bool "walkable" property and a string
+# "spawn" property naming the species that spawns there.
+class TilesetInfo:
+    def __init__(self):
+        self.walkable_ids = None  # None: fall back to WALKABLE_TILE_IDS
+        self.spawn_tile_ids = {}  # species -> set of tile IDs
+
+def parse_tileset_properties(tileset_element, info):
+    walkable_ids = set()
+    has_walkable = False
+    for tile in tileset_element.findall('tile'):
+        tile_id = int(tile.get('id'))
+        for prop in tile.findall('properties/property'):
+            name = prop.get('name')
+            value = prop.get('value', prop.text or '')
+            if name == 'walkable':
+                has_walkable = True
+                if value.lower() == 'true':
+                    walkable_ids.add(tile_id)
+            elif name == 'spawn' and value:
+                info.spawn_tile_ids.setdefault(value, set()).add(tile_id)
+    if has_walkable:
+        info.walkable_ids = walkable_ids
+
+def decode_tmx_layer(data_element, width, height):
+    encoding = data_element.get('encoding')
+    compression = data_element.get('compression')
+    if encoding == 'csv':
+        gids = [int(value) for value in data_element.text.replace('\n', '').split(',') if value.strip()]
+    elif encoding == 'base64':
+        raw = base64.b64decode(data_element.text.strip())
+        if compression == 'zlib':
+            raw = zlib.decompress(raw)
+        elif compression == 'gzip':
+            raw = gzip.decompress(raw)
+        elif compression:
+            raise ValueError(f"Unsupported TMX layer compression: {compression}")
+        gids = array('I', raw)
+        if sys.byteorder != 'little':
+            gids.byteswap()
+    else:
+        gids = [int(tile.get('gid', 0)) for tile in data_element.findall('tile')]
+    if len(gids) != width * height:
+        raise ValueError(f"TMX layer has {len(gids)} tiles, expected {width * height}")
+    return gids
+
+def load_tmx(filename):
+    root = ET.parse(filename).getroot()
+    width = int(root.get('width'))
+    height = int(root.get('height'))
+    base_dir = os.path.dirname(filename)
+
+    info = TilesetInfo()
+    dependencies = []
+    tileset_element = root.find('tileset')
+    firstgid = int(tileset_element.get('firstgid', 1))
+    source = tileset_element.get('source')
+    if source:
+        source = os.path.join(base_dir, source)
+        dependencies.append(source)
+        tileset_element = ET.parse(source).getroot()
+    parse_tileset_properties(tileset_element, info)
+
+    layer = root.find('layer')
+    gids = decode_tmx_layer(layer.find('data'), width, height)
+    tiles = array('h', ((gid & TMX_GID_MASK) - firstgid if gid & TMX_GID_MASK else -1 for gid in gids))
+    return width, height, tiles, info, dependencies
+
+# The binary cache is a small header, the tileset metadata as JSON, then the
+# raw array('h') tile data. It is only reused while the mtimes of the TMX file
+# and its external tilesets are unchanged; the tile data is memory-mapped.
+def tmx_cache_filename(filename):
+    return filename + '.cache'
+
+def read_map_cache(filename):
+    try:
+        stat = os.stat(filename)
+        with open(tmx_cache_filename(filename), 'rb') as cache_file:
+            header = cache_file.read(MAP_CACHE_HEADER.size)
+            if len(header) != MAP_CACHE_HEADER.size:
+                return None
+            magic, mtime_ns, width, height, metadata_size = MAP_CACHE_HEADER.unpack(header)
+            if magic != MAP_CACHE_MAGIC or mtime_ns != stat.st_mtime_ns:
+                return None
+            metadata = json.loads(cache_file.read(metadata_size))
+            for dependency, dependency_mtime_ns in metadata['dependencies'].items():
+                if os.stat(dependency).st_mtime_ns != dependency_mtime_ns:
+                    return None
+            mapped = mmap.mmap(cache_file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError, KeyError):
+        return None
+    data_offset = MAP_CACHE_HEADER.size + metadata_size
+    data_offset += data_offset % 2
+    tiles = memoryview(mapped)[data_offset:].cast('h')
+    if len(tiles) != width * height:
+        return None
+    info = TilesetInfo()
+    if metadata['walkable_ids'] is not None:
+        info.walkable_ids = set(metadata['walkable_ids'])
+    info.spawn_tile_ids = {species: set(tile_ids) for species, tile_ids in metadata['spawn_tile_ids'].items()}
+    return width, height, tiles, info
+
+def write_map_cache(filename, width, height, tiles, info, dependencies):
+    cache_filename = tmx_cache_filename(filename)
+    metadata = json.dumps({
+        'walkable_ids': sorted(info.walkable_ids) if info.walkable_ids is not None else None,
+        'spawn_tile_ids': {species: sorted(tile_ids) for species, tile_ids in info.spawn_tile_ids.items()},
+        'dependencies': {dependency: os.stat(dependency).st_mtime_ns for dependency in dependencies},
+    }).encode()
+    try:
+        with open(cache_filename + '.tmp', 'wb') as cache_file:
+            cache_file.write(MAP_CACHE_HEADER.pack(MAP_CACHE_MAGIC, os.stat(filename).st_mtime_ns, width, height, len(metadata)))
+            cache_file.write(metadata)
+            if (MAP_CACHE_HEADER.size + len(metadata)) % 2:
+                cache_file.write(b'\0')
+            tiles.tofile(cache_file)
+        os.replace(cache_filename + '.tmp', cache_filename)
+    except OSError as e:
+        print("Error writing map cache:", e)
+
+# Load a TMX map, preferring the binary cache
+def load_tmx_cached(filename):
+    cached = read_map_cache(filename)
+    if cached is not None:
+        return cached
+    width, height, tiles, info, dependencies = load_tmx(filename)
+    write_map_cache(filename, width, height, tiles, info, dependencies)
+    return width, height, tiles, info
 
 def find_tile_position(map_data, tile_id):
-    for y, row in enumerate(map_data.map_data):
-        for x, tile in enumerate(row):
-            if tile == tile_id:
-                return x * TILE_SIZE, y * TILE_SIZE
+    positions = map_data.tile_positions.get(tile_id)
+    if positions:
+        return (positions[0] % map_data.width) * TILE_SIZE, (positions[0] // map_data.width) * TILE_SIZE
+    return None
+
+def find_spawn_position(map_data, species):
+    for tile_id in sorted(map_data.spawn_tile_ids.get(species, ())):
+        position = find_tile_position(map_data, tile_id)
+        if position is not None:
+            return position
     return None
 
+# Accumulates wall-clock time per named phase. Call start() at the top of a
+# frame, lap(name) at the end of each phase and end_frame() once the frame is
+# done; a disabled Profiler returns immediately so the calls can stay in hot
+# paths. Every finished frame is kept in a rolling window for the HUD and
+# handed to the listeners as a sample dict.
+class Profiler:
+    def __init__(self, enabled=True, window=60):
+        self.enabled = enabled
+        self.totals = defaultdict(float)  # phase -> seconds
+        self.frame = defaultdict(float)   # phase -> seconds in the current frame
+        self.history = deque(maxlen=window)
+        self.listeners = []
+        self.frames = 0
+        self.blocks = sys.getallocatedblocks()
+        self.last = time.perf_counter()
+
+    def start(self):
+        if self.enabled:
+            self.last = time.perf_counter()
+
+    def lap(self, name):
+        if self.enabled:
+            now = time.perf_counter()
+            elapsed = now - self.last
+            self.totals[name] += elapsed
+            self.frame[name] += elapsed
+            self.last = now
+
+    # counts is a dict of entity counts to report alongside the timings
+    def end_frame(self, counts=None):
+        if not self.enabled:
+            return
+        blocks = sys.getallocatedblocks()
+        sample = {
+            'frame': self.frames,
+            'ms': {name: elapsed * 1000 for name, elapsed in self.frame.items()},
+            'counts': counts or {},
+            'allocated_blocks': blocks,
+            'allocated_delta': blocks - self.blocks,
+        }
+        self.blocks = blocks
+        self.frames += 1
+        self.frame = defaultdict(float)
+        self.history.append(sample)
+        for listener in self.listeners:
+            try:
+                listener(sample)
+            except Exception as e:
+                print("Error in profiler listener:", e)
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self.listeners.remove(listener)
+
+    # Mean ms per phase over the rolling window
+    def averages(self):
+        sums = defaultdict(float)
+        for sample in self.history:
+            for name, ms in sample['ms'].items():
+                sums[name] += ms
+        count = max(len(self.history), 1)
+        return {name: total / count for name, total in sums.items()}
+
+    def reset(self):
+        self.totals.clear()
+        self.frame.clear()
+        self.history.clear()
+        self.last = time.perf_counter()
+
+# Profiler listener that appends each sample to a file as a JSON line
+class ProfileFileSink:
+    def __init__(self, filename):
+        self.file = open(filename, 'a')
+
+    def __call__(self, sample):
+        self.file.write(json.dumps(sample) + '\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+# Profiler listener that sends each sample as a JSON datagram, e.g. to a
+# local `nc -ul 9999`. UDP never blocks the game if nobody is listening.
+class ProfileSocketSink:
+    def __init__(self, host='127.0.0.1', port=9999):
+        self.address = (host, port)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def __call__(self, sample):
+        try:
+            self.socket.sendto(json.dumps(sample).encode('utf-8'), self.address)
+        except OSError:
+            pass
+
+    def close(self):
+        self.socket.close()
+
+NULL_PROFILER = Profiler(enabled=False)
+
+# Uniform grid of TILE_SIZE cells used for NPC collision and neighbor queries.
+# Each NPC is registered in every cell its rect touches and is only re-bucketed
+# when it crosses a cell boundary, so queries cost O(local density).
+class SpatialHash:
+    def __init__(self, cell_size=TILE_SIZE):
+        self.cell_size = cell_size
+        self.cells = {}
+        self.entries = {}  # npc -> (min_cx, min_cy, max_cx, max_cy)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, npc):
+        return npc in self.entries
+
+    def __iter__(self):
+        return iter(list(self.entries))
+
+    def cell_range(self, x, y, width, height):
+        x, y = int(x), int(y)
+        cell_size = self.cell_size
+        return x // cell_size, y // cell_size, (x + width - 1) // cell_size, (y + height - 1) // cell_size
+
+    def insert(self, npc):
+        if npc in self.entries:
+            self.move(npc)
+            return
+        cell_range = self.cell_range(npc.x, npc.y, npc.tile_size, npc.tile_size)
+        self.entries[npc] = cell_range
+        self._add_to_cells(npc, cell_range)
+        npc.spatial_hash = self
+
+    def remove(self, npc):
+        cell_range = self.entries.pop(npc, None)
+        if cell_range is not None:
+            self._remove_from_cells(npc, cell_range)
+            npc.spatial_hash = None
+
+    def move(self, npc):
+        old_range = self.entries.get(npc)
+        if old_range is None:
+            return
+        new_range = self.cell_range(npc.x, npc.y, npc.tile_size, npc.tile_size)
+        if new_range != old_range:
+            self._remove_from_cells(npc, old_range)
+            self._add_to_cells(npc, new_range)
+            self.entries[npc] = new_range
+
+    def _add_to_cells(self, npc, cell_range):
+        min_cx, min_cy, max_cx, max_cy = cell_range
+        cells = self.cells
+        for cy in range(min_cy, max_cy + 1):
+            for cx in range(min_cx, max_cx + 1):
+                bucket = cells.get((cx, cy))
+                if bucket is None:
+                    bucket = cells[(cx, cy)] = {}
+                bucket[npc] = None
+
+    def _remove_from_cells(self, npc, cell_range):
+        min_cx, min_cy, max_cx, max_cy = cell_range
+        cells = self.cells
+        for cy in range(min_cy, max_cy + 1):
+            for cx in range(min_cx, max_cx + 1):
+                bucket = cells.get((cx, cy))
+                if bucket is not None:
+                    bucket.pop(npc, None)
+                    if not bucket:
+                        del cells[(cx, cy)]
+
+    # Returns the NPCs whose rects collide with rect, in a deterministic order
+    def query(self, rect, exclude=None):
+        min_cx, min_cy, max_cx, max_cy = self.cell_range(rect.x, rect.y, max(rect.width, 1), max(rect.height, 1))
+        cells = self.cells
+        seen = {}
+        for cy in range(min_cy, max_cy + 1):
+            for cx in range(min_cx, max_cx + 1):
+                bucket = cells.get((cx, cy))
+                if bucket:
+                    for npc in bucket:
+                        if npc is not exclude and npc not in seen:
+                            seen[npc] = None
+        return [npc for npc in seen if rect.colliderect(npc.get_rect())]
+
+# Point grid over prey positions, rebuilt once per tick so every hunter can
+# find its nearest target by scanning only the buckets within its radius.
+class PreyIndex:
+    def __init__(self, cell_size=PIG_CHASE_RADIUS):
+        self.cell_size = cell_size
+        self.cells = {}
+        self.store = None
+
+    def rebuild(self, prey):
+        self.store = None
+        cell_size = self.cell_size
+        cells = {}
+        for npc in prey:
+            if npc.alive:
+                key = (int(npc.x) // cell_size, int(npc.y) // cell_size)
+                bucket = cells.get(key)
+                if bucket is None:
+                    cells[key] = [npc]
+                else:
+                    bucket.append(npc)
+        self.cells = cells
+
+    # Vectorized rebuild for prey held in an EntityStore; buckets hold arrays
+    # of store indices instead of NPC objects
+    def rebuild_from_store(self, store, indices):
+        self.store = store
+        self.cells = {}
+        if indices.size == 0:
+            return
+        cell_x = np.floor_divide(np.trunc(store.x[indices]), self.cell_size).astype('int64')
+        cell_y = np.floor_divide(np.trunc(store.y[indices]), self.cell_size).astype('int64')
+        order = np.lexsort((cell_y, cell_x))
+        cell_x, cell_y, indices = cell_x[order], cell_y[order], indices[order]
+        starts = np.flatnonzero(np.r_[True, (cell_x[1:] != cell_x[:-1]) | (cell_y[1:] != cell_y[:-1])])
+        for start, end in zip(starts, np.r_[starts[1:], indices.size]):
+            self.cells[(int(cell_x[start]), int(cell_y[start]))] = indices[start:end]
+
+    def nearest(self, x, y, max_distance):
+        if self.store is not None:
+            return self.nearest_in_store(x, y, max_distance)
+        cell_size = self.cell_size
+        cells = self.cells
+        closest = None
+        closest_distance_sq = max_distance * max_distance
+        for cy in range(int(y - max_distance) // cell_size, int(y + max_distance) // cell_size + 1):
+            for cx in range(int(x - max_distance) // cell_size, int(x + max_distance) // cell_size + 1):
+                bucket = cells.get((cx, cy))
+                if bucket:
+                    for npc in bucket:
+                        dx = npc.x - x
+                        dy = npc.y - y
+                        distance_sq = dx * dx + dy * dy
+                        if distance_sq < closest_distance_sq and npc.alive:
+                            closest_distance_sq = distance_sq
+                            closest = npc
+        return closest
+
+    def nearest_in_store(self, x, y, max_distance):
+        cell_size = self.cell_size
+        cells = self.cells
+        buckets = []
+        for cy in range(int(y - max_distance) // cell_size, int(y + max_distance) // cell_size + 1):
+            for cx in range(int(x - max_distance) // cell_size, int(x + max_distance) // cell_size + 1):
+                bucket = cells.get((cx, cy))
+                if bucket is not None:
+                    buckets.append(bucket)
+        if not buckets:
+            return None
+        store = self.store
+        candidates = np.concatenate(buckets)
+        dx = store.x[candidates] - x
+        dy = store.y[candidates] - y
+        distance_sq = dx * dx + dy * dy
+        distance_sq[~store.alive[candidates]] = np.inf
+        closest = np.argmin(distance_sq)
+        if distance_sq[closest] < max_distance * max_distance:
+            return store.npcs[candidates[closest]]
+        return None
+
+# Fresh decals (blood puddles) in a fixed-size ring buffer, drawn over the
+# map chunks. Each fades from full opacity to DECAL_SETTLED_ALPHA over
+# fade_duration ticks, then settles: it is baked into the map's chunks and
+# leaves the buffer. When the buffer is full the oldest decal settles early,
+# so the per-frame cost never exceeds capacity decals however many die.
+class DecalLayer:
+    def __init__(self, game_map, capacity=DECAL_CAPACITY, fade_duration=BLOOD_SPLAT_FADE_DURATION):
+        self.game_map = game_map
+        self.capacity = capacity
+        self.fade_duration = fade_duration
+        self.decals = [None] * capacity  # [image, x, y, age]; oldest at tail
+        self.tail = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def fade_step(self, age):
+        return min(age * DECAL_FADE_STEPS // self.fade_duration, DECAL_FADE_STEPS - 1)
+
+    # Fades are built by add(), so drawing never allocates surfaces
+    def faded_image(self, image, step):
+        return decal_fades[image][step]
+
+    # Lay a decal; puddle fades are prebuilt with World, other images get
+    # theirs on first use
+    def add(self, image, x, y):
+        get_decal_fades(image)
+        if self.count == self.capacity:
+            self.settle_oldest()
+        self.decals[(self.tail + self.count) % self.capacity] = [image, x, y, 0]
+        self.count += 1
+        self.game_map.mark_changed(x, y, image)
+
+    def settle_oldest(self):
+        image, x, y, _ = self.decals[self.tail]
+        self.decals[self.tail] = None
+        self.tail = (self.tail + 1) % self.capacity
+        self.count -= 1
+        # An early settle jumps straight to the settled alpha
+        self.game_map.mark_changed(x, y, image)
+        self.game_map.bake_decal(self.faded_image(image, DECAL_FADE_STEPS - 1), x, y)
+
+    # Age every decal by a tick; a decal reaching a new alpha level marks
+    # its rect changed, and decals done fading settle
+    def update(self):
+        capacity = self.capacity
+        game_map = self.game_map
+        for i in range(self.count):
+            decal = self.decals[(self.tail + i) % capacity]
+            step = self.fade_step(decal[3])
+            decal[3] += 1
+            if self.fade_step(decal[3]) != step:
+                game_map.mark_changed(decal[1], decal[2], decal[0])
+        # Decals age together, so the ones done fading are all at the tail
+        while self.count and self.decals[self.tail][3] >= self.fade_duration:
+            self.settle_oldest()
+
+    # Blit the decals overlapping area (a screen rect)
+    def draw(self, screen, offset_x, offset_y, area):
+        view = area.move(offset_x, offset_y)
+        capacity = self.capacity
+        blits = []
+        for i in range(self.count):
+            image, x, y, age = self.decals[(self.tail + i) % capacity]
+            if view.colliderect((x, y, image.get_width(), image.get_height())):
+                blits.append((self.faded_image(image, self.fade_step(age)), (x - offset_x, y - offset_y)))
+        if blits:
+            screen.blits(blits, doreturn=False)
+
 # Map class
+# The map is rendered lazily in MAP_CHUNK_TILES-sized chunks as they scroll
+# into view; rendered chunks are kept in an LRU cache capped at
+# chunk_cache_bytes. Decals are recorded per chunk so an evicted chunk can be
+# rebuilt with them.
 class Map:
-    def __init__(self, filename, tileset, default_tile):
+    def __init__(self, filename, tileset, default_tile, chunk_cache_bytes=MAP_CHUNK_CACHE_BYTES):
+        self.walkable_ids = set(WALKABLE_TILE_IDS)
+        self.spawn_tile_ids = {'chicken': {CHICKEN_SPAWN_TILE_ID}}
         self.map_data = self.load_map(filename)
+        self.width = len(self.map_data[0])
+        self.height = len(self.map_data)
+        self.walkable = self.build_walkable_grid()
+        self.tile_positions = self.build_tile_index()
+        self.spawn_cell_cache = {}  # footprint in tiles -> spawn_cells()
         self.tileset = tileset
         self.default_tile = default_tile
-        self.surface = pygame.Surface((MAP_WIDTH * TILE_SIZE, MAP_HEIGHT * TILE_SIZE))
-        self.draw_map()
+        self.chunk_size = MAP_CHUNK_TILES * TILE_SIZE
+        self.chunk_cache_bytes = chunk_cache_bytes
+        self.chunk_bytes = 0
+        self.chunks = OrderedDict()  # (chunk_x, chunk_y) -> Surface
+        self.decals = {}  # (chunk_x, chunk_y) -> deque of the last DECAL_CHUNK_LIMIT (image, (x, y)) baked there
+        self.decal_layer = DecalLayer(self)
+        # World rects redrawn since take_changed_rects(); None until the first
+        # call, so a World that is never drawn doesn't pile them up
+        self.changed_rects = None
 
     def load_map(self, filename):
+        if filename.endswith('.tmx'):
+            width, height, tiles, info = load_tmx_cached(filename)
+            if info.walkable_ids is not None:
+                self.walkable_ids = info.walkable_ids
+            self.spawn_tile_ids.update(info.spawn_tile_ids)
+            # Row views over the flat (possibly memory-mapped) tile array
+            return [tiles[y * width:(y + 1) * width] for y in range(height)]
         with open(filename, newline='') as csvfile:
             reader = csv.reader(csvfile, delimiter=',')
             return [list(map(int, row)) for row in reader]
 
-    def is_walkable(self, x, y, character_width, character_height):
-        center_x = x + character_width // 2
-        center_y = y + character_height // 2
-        tile_x = center_x // TILE_SIZE
-        tile_y = center_y // TILE_SIZE
-        if tile_x < 0 or tile_x >= MAP_WIDTH or tile_y < 0 or tile_y >= MAP_HEIGHT or self.map_data[tile_y][tile_x] not in WALKABLE_TILE_IDS:
-            return False
-        return True
-
-    def draw_map(self):
+    # One byte per tile, row-major: 1 if walkable, 0 otherwise
+    def build_walkable_grid(self):
+        walkable_ids = self.walkable_ids
+        grid = bytearray(self.width * self.height)
+        for y, row in enumerate(self.map_data):
+            base = y * self.width
+            for x, tile in enumerate(row):
+                if tile in walkable_ids:
+                    grid[base + x] = 1
+        return grid
+
+    # Tile ID -> row-major indices (y * width + x) of every tile with that ID
+    def build_tile_index(self):
+        index = {}
         for y, row in enumerate(self.map_data):
+            base = y * self.width
             for x, tile in enumerate(row):
-                self.surface.blit(self.default_tile, (x * TILE_SIZE, y * TILE_SIZE))
+                positions = index.get(tile)
+                if positions is None:
+                    positions = index[tile] = array('l')
+                positions.append(base + x)
+        return index
+
+    # Row-major indices of the top-left tiles of every fully walkable square
+    # large enough for a sprite footprint pixels wide, built on first use
+    def spawn_cells(self, footprint):
+        tiles = max(1, -(-footprint // TILE_SIZE))
+        cells = self.spawn_cell_cache.get(tiles)
+        if cells is None:
+            cells = self.spawn_cell_cache[tiles] = self.find_open_squares(tiles)
+        return cells
+
+    def find_open_squares(self, tiles):
+        width = self.width
+        walkable = self.walkable
+        below = [0] * width  # Rows in a row, from this one down, with a walkable run of `tiles` at x
+        cells = []
+        for y in range(self.height - 1, -1, -1):
+            base = y * width
+            run = 0
+            for x in range(width - 1, -1, -1):
+                run = run + 1 if walkable[base + x] else 0
+                below[x] = below[x] + 1 if run >= tiles else 0
+                if below[x] >= tiles:
+                    cells.append(base + x)
+        cells.reverse()
+        return array('l', cells)
+
+    def is_tile_walkable(self, tile_x, tile_y):
+        if 0 <= tile_x < self.width and 0 <= tile_y < self.height:
+            return self.walkable[tile_y * self.width + tile_x] == 1
+        return False
+
+    def is_walkable(self, x, y, character_width, character_height):
+        tile_x = int(x + character_width // 2) // TILE_SIZE
+        tile_y = int(y + character_height // 2) // TILE_SIZE
+        return self.is_tile_walkable(tile_x, tile_y)
+
+    # NumPy version of is_walkable for arrays of positions and sizes
+    def walkable_mask(self, xs, ys, sizes):
+        grid = np.frombuffer(self.walkable, dtype=np.uint8)
+        half = sizes // 2
+        tile_x = np.trunc(xs + half).astype('int64') // TILE_SIZE
+        tile_y = np.trunc(ys + half).astype('int64') // TILE_SIZE
+        inside = (tile_x >= 0) & (tile_x < self.width) & (tile_y >= 0) & (tile_y < self.height)
+        return inside & (grid[np.where(inside, tile_y * self.width + tile_x, 0)] == 1)
+
+    def render_chunk(self, chunk_x, chunk_y):
+        atlas = get_tile_atlas(self.tileset)
+        first_x = chunk_x * MAP_CHUNK_TILES
+        first_y = chunk_y * MAP_CHUNK_TILES
+        last_x = min(first_x + MAP_CHUNK_TILES, self.width)
+        last_y = min(first_y + MAP_CHUNK_TILES, self.height)
+        surface = pygame.Surface(((last_x - first_x) * TILE_SIZE, (last_y - first_y) * TILE_SIZE))
+        blits = []
+        for y in range(first_y, last_y):
+            row = self.map_data[y]
+            for x in range(first_x, last_x):
+                tile = row[x]
+                position = ((x - first_x) * TILE_SIZE, (y - first_y) * TILE_SIZE)
+                # The default tile only shows through transparent tiles
+                if tile < 0 or not atlas.is_opaque(tile):
+                    blits.append((self.default_tile, position))
                 if tile >= 0:
-                    tile_image = get_tile_image(self.tileset, tile)
-                    self.surface.blit(tile_image, (x * TILE_SIZE, y * TILE_SIZE))
+                    blits.append((atlas.get(tile), position))
+        origin_x = chunk_x * self.chunk_size
+        origin_y = chunk_y * self.chunk_size
+        for image, (x, y) in self.decals.get((chunk_x, chunk_y), ()):
+            blits.append((image, (x - origin_x, y - origin_y)))
+        surface.blits(blits, doreturn=False)
+        return surface
+
+    def get_chunk(self, chunk_x, chunk_y):
+        key = (chunk_x, chunk_y)
+        chunk = self.chunks.get(key)
+        if chunk is not None:
+            self.chunks.move_to_end(key)
+            return chunk
+        chunk = self.render_chunk(chunk_x, chunk_y)
+        size = chunk.get_width() * chunk.get_height() * chunk.get_bytesize()
+        while self.chunks and self.chunk_bytes + size > self.chunk_cache_bytes:
+            _, evicted = self.chunks.popitem(last=False)
+            self.chunk_bytes -= evicted.get_width() * evicted.get_height() * evicted.get_bytesize()
+        self.chunks[key] = chunk
+        self.chunk_bytes += size
+        return chunk
+
+    def visible_chunks(self, offset_x, offset_y, view_width, view_height):
+        last_chunk_x = (self.width - 1) // MAP_CHUNK_TILES
+        last_chunk_y = (self.height - 1) // MAP_CHUNK_TILES
+        min_x = max(0, int(offset_x) // self.chunk_size)
+        min_y = max(0, int(offset_y) // self.chunk_size)
+        max_x = min(last_chunk_x, int(offset_x + view_width - 1) // self.chunk_size)
+        max_y = min(last_chunk_y, int(offset_y + view_height - 1) // self.chunk_size)
+        return [(chunk_x, chunk_y) for chunk_y in range(min_y, max_y + 1) for chunk_x in range(min_x, max_x + 1)]
+
+    # Blit the chunks covering the screen, or only those under area (a screen
+    # rect) when redrawing part of it
+    def draw(self, screen, offset_x, offset_y, area=None):
+        if area is None:
+            area = screen.get_rect()
+        blits = []
+        for chunk_x, chunk_y in self.visible_chunks(offset_x + area.x, offset_y + area.y, area.width, area.height):
+            blits.append((self.get_chunk(chunk_x, chunk_y), (chunk_x * self.chunk_size - offset_x, chunk_y * self.chunk_size - offset_y)))
+        screen.blits(blits, doreturn=False)
+        self.decal_layer.draw(screen, offset_x, offset_y, area)
+
+    # Lay image at world position (x, y); it fades in the decal layer before
+    # it is baked into the map
+    def add_decal(self, image, x, y):
+        self.decal_layer.add(image, x, y)
+
+    def update_decals(self):
+        self.decal_layer.update()
+
+    # Stamp image at world position (x, y) into every chunk it overlaps.
+    # Each chunk keeps only its last DECAL_CHUNK_LIMIT decals for rebuilding
+    # after LRU eviction: older ones stay on a cached chunk but are gone once
+    # it is rebuilt, so a heavily bloodied spot slowly washes clean.
+    def bake_decal(self, image, x, y):
+        chunk_size = self.chunk_size
+        for chunk_y in range(max(0, y // chunk_size), (y + image.get_height() - 1) // chunk_size + 1):
+            for chunk_x in range(max(0, x // chunk_size), (x + image.get_width() - 1) // chunk_size + 1):
+                decals = self.decals.get((chunk_x, chunk_y))
+                if decals is None:
+                    decals = self.decals[(chunk_x, chunk_y)] = deque(maxlen=DECAL_CHUNK_LIMIT)
+                decals.append((image, (x, y)))
+                chunk = self.chunks.get((chunk_x, chunk_y))
+                if chunk is not None:
+                    chunk.blit(image, (x - chunk_x * chunk_size, y - chunk_y * chunk_size))
+
+    # Note that image, placed at world position (x, y), changed the map
+    def mark_changed(self, x, y, image):
+        if self.changed_rects is not None:
+            self.changed_rects.append(pygame.Rect(x, y, image.get_width(), image.get_height()))
+
+    def take_changed_rects(self):
+        rects = self.changed_rects or []
+        self.changed_rects = []
+        return rects
+
+# A* search over the walkable tile grid. Searches are resumable so that the
+# Pathfinder can spread them over several frames.
+class PathSearch:
+    def __init__(self, map_data, start, goal, jump_point=True, max_expansions=PATH_MAX_EXPANSIONS):
+        self.map_data = map_data
+        self.start = start
+        self.goal = goal
+        self.jump_point = jump_point
+        self.max_expansions = max_expansions
+        self.expansions = 0
+        self.done = False
+        self.path = None
+        self.counter = 0
+        self.g_score = {start: 0}
+        self.came_from = {start: None}
+        self.closed = set()
+        self.open_heap = [(self.heuristic(start), 0, start)]
+        if not map_data.is_tile_walkable(*start) or not map_data.is_tile_walkable(*goal):
+            self.done = True
+
+    # Octile distance, admissible for 8-way movement
+    def heuristic(self, node):
+        dx = abs(node[0] - self.goal[0])
+        dy = abs(node[1] - self.goal[1])
+        return max(dx, dy) + (SQRT_2 - 1) * min(dx, dy)
+
+    # Expand up to budget nodes; returns the number of expansions used
+    def step(self, budget):
+        used = 0
+        open_heap = self.open_heap
+        while open_heap and used < budget and not self.done:
+            _, _, node = heapq.heappop(open_heap)
+            if node in self.closed:
+                continue
+            if node == self.goal:
+                self.path = self.reconstruct(node)
+                self.done = True
+                break
+            self.closed.add(node)
+            used += 1
+            self.expansions += 1
+            if self.expansions >= self.max_expansions:
+                self.done = True
+                break
+            successors = self.jump_successors(node) if self.jump_point else self.neighbors(node)
+            for successor in successors:
+                if successor in self.closed:
+                    continue
+                dx = abs(successor[0] - node[0])
+                dy = abs(successor[1] - node[1])
+                tentative_g = self.g_score[node] + max(dx, dy) + (SQRT_2 - 1) * min(dx, dy)
+                if tentative_g < self.g_score.get(successor, float('inf')):
+                    self.g_score[successor] = tentative_g
+                    self.came_from[successor] = node
+                    self.counter += 1
+                    heapq.heappush(open_heap, (tentative_g + self.heuristic(successor), self.counter, successor))
+        if not open_heap:
+            self.done = True
+        return used
+
+    # 8-way neighbors; diagonals are only allowed when both adjacent sides are open
+    def neighbors(self, node):
+        x, y = node
+        walkable = self.map_data.is_tile_walkable
+        result = []
+        for dx, dy in ((1, 0), (-1, 0), (0, 1), (0, -1)):
+            if walkable(x + dx, y + dy):
+                result.append((x + dx, y + dy))
+        for dx, dy in ((1, 1), (1, -1), (-1, 1), (-1, -1)):
+            if walkable(x + dx, y + dy) and walkable(x + dx, y) and walkable(x, y + dy):
+                result.append((x + dx, y + dy))
+        return result
+
+    # Jump point search: prune the neighbors of node by the direction it was
+    # reached from, then jump along each remaining direction
+    def jump_successors(self, node):
+        parent = self.came_from[node]
+        if parent is None:
+            candidates = self.neighbors(node)
+        else:
+            candidates = self.pruned_neighbors(node, parent)
+        x, y = node
+        successors = []
+        for nx, ny in candidates:
+            jump_point = self.jump(nx, ny, nx - x, ny - y)
+            if jump_point is not None:
+                successors.append(jump_point)
+        return successors
+
+    def pruned_neighbors(self, node, parent):
+        x, y = node
+        dx = (x > parent[0]) - (x < parent[0])
+        dy = (y > parent[1]) - (y < parent[1])
+        walkable = self.map_data.is_tile_walkable
+        result = []
+        if dx and dy:
+            walkable_y = walkable(x, y + dy)
+            walkable_x = walkable(x + dx, y)
+            if walkable_y:
+                result.append((x, y + dy))
+            if walkable_x:
+                result.append((x + dx, y))
+            if walkable_x and walkable_y and walkable(x + dx, y + dy):
+                result.append((x + dx, y + dy))
+        elif dx:
+            next_walkable = walkable(x + dx, y)
+            top_walkable = walkable(x, y + 1)
+            bottom_walkable = walkable(x, y - 1)
+            if next_walkable:
+                result.append((x + dx, y))
+                if top_walkable and walkable(x + dx, y + 1):
+                    result.append((x + dx, y + 1))
+                if bottom_walkable and walkable(x + dx, y - 1):
+                    result.append((x + dx, y - 1))
+            if top_walkable:
+                result.append((x, y + 1))
+            if bottom_walkable:
+                result.append((x, y - 1))
+        else:
+            next_walkable = walkable(x, y + dy)
+            right_walkable = walkable(x + 1, y)
+            left_walkable = walkable(x - 1, y)
+            if next_walkable:
+                result.append((x, y + dy))
+                if right_walkable and walkable(x + 1, y + dy):
+                    result.append((x + 1, y + dy))
+                if left_walkable and walkable(x - 1, y + dy):
+                    result.append((x - 1, y + dy))
+            if right_walkable:
+                result.append((x + 1, y))
+            if left_walkable:
+                result.append((x - 1, y))
+        return result
+
+    def jump(self, x, y, dx, dy):
+        walkable = self.map_data.is_tile_walkable
+        goal = self.goal
+        while True:
+            if not walkable(x, y):
+                return None
+            if (x, y) == goal:
+                return x, y
+            if dx and dy:
+                if self.jump(x + dx, y, dx, 0) is not None or self.jump(x, y + dy, 0, dy) is not None:
+                    return x, y
+                if not (walkable(x + dx, y) and walkable(x, y + dy)):
+                    return None
+            elif dx:
+                if (walkable(x, y - 1) and not walkable(x - dx, y - 1)) or (walkable(x, y + 1) and not walkable(x - dx, y + 1)):
+                    return x, y
+            else:
+                if (walkable(x - 1, y) and not walkable(x - 1, y - dy)) or (walkable(x + 1, y) and not walkable(x + 1, y - dy)):
+                    return x, y
+            x += dx
+            y += dy
+
+    # Walk came_from back to the start, filling in the straight or diagonal
+    # runs between jump points so the result is a list of adjacent tiles
+    def reconstruct(self, node):
+        points = []
+        while node is not None:
+            points.append(node)
+            node = self.came_from[node]
+        points.reverse()
+        path = [points[0]]
+        for x, y in points[1:]:
+            px, py = path[-1]
+            dx = (x > px) - (x < px)
+            dy = (y > py) - (y < py)
+            while (px, py) != (x, y):
+                px += dx
+                py += dy
+                path.append((px, py))
+        return path
+
+# Shared path service: caches finished paths by (start tile, goal tile) with
+# LRU eviction and spends at most node_budget expansions per frame on the
+# queued requests.
+class Pathfinder:
+    def __init__(self, map_data, jump_point=True, cache_size=PATH_CACHE_SIZE, node_budget=PATH_NODE_BUDGET):
+        self.map_data = map_data
+        self.jump_point = jump_point
+        self.cache_size = cache_size
+        self.node_budget = node_budget
+        self.cache = OrderedDict()
+        self.pending = OrderedDict()  # npc -> PathSearch
+
+    def tile_at(self, x, y):
+        return int(x) // TILE_SIZE, int(y) // TILE_SIZE
+
+    def cached_path(self, start, goal):
+        key = (start, goal)
+        path = self.cache.get(key)
+        if path is not None:
+            self.cache.move_to_end(key)
+        return path
+
+    def store_path(self, start, goal, path):
+        self.cache[(start, goal)] = path
+        self.cache.move_to_end((start, goal))
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    # Queue a path for npc towards the pixel position (goal_x, goal_y)
+    def request(self, npc, goal_x, goal_y):
+        start = self.tile_at(npc.x + npc.tile_size // 2, npc.y + npc.tile_size // 2)
+        goal = self.tile_at(goal_x, goal_y)
+        path = self.cached_path(start, goal)
+        if path is not None:
+            self.pending.pop(npc, None)
+            self.assign_path(npc, path)
+            return
+        search = self.pending.get(npc)
+        if search is None or search.goal != goal:
+            self.pending[npc] = PathSearch(self.map_data, start, goal, self.jump_point)
+
+    def cancel(self, npc):
+        self.pending.pop(npc, None)
+
+    def assign_path(self, npc, path):
+        half = npc.tile_size // 2
+        npc.path = [(x * TILE_SIZE + TILE_SIZE // 2 - half, y * TILE_SIZE + TILE_SIZE // 2 - half) for x, y in path[1:]]
+
+    # Advance queued searches, oldest first, until the frame budget runs out
+    def update(self):
+        budget = self.node_budget
+        while self.pending and budget > 0:
+            npc, search = next(iter(self.pending.items()))
+            budget -= search.step(budget)
+            if search.done:
+                del self.pending[npc]
+                path = tuple(search.path or ())
+                self.store_path(search.start, search.goal, path)
+                if npc.alive:
+                    self.assign_path(npc, path)
+            else:
+                break
 
 # Character class
 class Character:
@@ -124,13 +1237,9 @@ class Character:
         self.attack_frames = self.load_frames(self.sword_tileset, 64, 64)
         self.offset_x, self.offset_y = 0, 0
 
+    # The sheets are drawn at half size
     def load_frames(self, tileset, frame_width, frame_height, offset_x=0):
-        frames = [[], [], [], []]
-        for direction in range(4):
-            for frame in range(4):
-                rect = pygame.Rect(frame * (frame_width // 2) + offset_x, direction * (frame_height // 2), frame_width // 2, frame_height // 2)
-                frames[direction].append(pygame.transform.scale(tileset.subsurface(rect), (frame_width, frame_height)))
-        return frames
+        return get_sprite_frames(tileset, frame_width // 2, frame_height // 2, 4, offset_x, scale=2)
 
     def update(self, keys, map_data):
         moving = False
@@ -162,17 +1271,19 @@ class Character:
         else:
             self.frame = 0
 
-        self.x = max(0, min(self.x, MAP_WIDTH * TILE_SIZE - self.width))
-        self.y = max(0, min(self.y, MAP_HEIGHT * TILE_SIZE - self.height))
+        map_width = map_data.width * TILE_SIZE
+        map_height = map_data.height * TILE_SIZE
+        self.x = max(0, min(self.x, map_width - self.width))
+        self.y = max(0, min(self.y, map_height - self.height))
 
         if self.x - self.offset_x < SCREEN_WIDTH // 4:
             self.offset_x = max(0, self.x - SCREEN_WIDTH // 4)
         if self.x - self.offset_x > SCREEN_WIDTH * 3 // 4:
-            self.offset_x = min(MAP_WIDTH * TILE_SIZE - SCREEN_WIDTH, self.x - SCREEN_WIDTH * 3 // 4)
+            self.offset_x = min(map_width - SCREEN_WIDTH, self.x - SCREEN_WIDTH * 3 // 4)
         if self.y - self.offset_y < SCREEN_HEIGHT // 4:
             self.offset_y = max(0, self.y - SCREEN_HEIGHT // 4)
         if self.y - self.offset_y > SCREEN_HEIGHT * 3 // 4:
-            self.offset_y = min(MAP_HEIGHT * TILE_SIZE - SCREEN_HEIGHT, self.y - SCREEN_HEIGHT * 3 // 4)
+            self.offset_y = min(map_height - SCREEN_HEIGHT, self.y - SCREEN_HEIGHT * 3 // 4)
 
         self.frame_counter += 1
         if self.frame_counter >= self.animation_speed:
@@ -184,17 +1295,16 @@ class Character:
             elif self.attacking:
                 self.frame = (self.frame + 1) % 4
 
-    def draw(self, screen):
+    def image(self):
         if self.attacking:
-            screen.blit(self.attack_frames[self.direction][self.frame], (self.x - self.offset_x, self.y - self.offset_y))
-        else:
-            screen.blit(self.walk_frames[self.direction][self.frame], (self.x - self.offset_x, self.y - self.offset_y))
+            return self.attack_frames[self.direction][self.frame]
+        return self.walk_frames[self.direction][self.frame]
 
     def attack(self):
         self.attacking = True
         self.attack_counter = self.attack_duration
 
-    def update_attack(self, npcs, map_surface):
+    def update_attack(self, npc_index, game_map):
         if self.attacking:
             attack_rect = None
             if self.direction == 0:  # Down
@@ -207,33 +1317,587 @@ class Character:
                 attack_rect = pygame.Rect(self.x - self.width // 2, self.y, self.width // 2, self.height)
 
             if attack_rect:
-                for npc in npcs:
-                    npc_rect = npc.get_rect()
-                    if npc_rect.colliderect(attack_rect) and npc.alive:
-                        npc.take_damage(1, self.x, self.y, map_surface)
+                for npc in npc_index.query(attack_rect):
+                    if npc.alive:
+                        npc.take_damage(1, self.x, self.y, game_map)
 
             self.attack_counter -= 1
             if self.attack_counter <= 0:
                 self.attacking = False
                 self.frame = 0
 
+# Per-NPC fields that live in an EntityStore's arrays when the NPC has one,
+# and in the instance dict otherwise (e.g. the wizard)
+class StoreField:
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, npc, owner=None):
+        if npc is None:
+            return self
+        store = npc.store
+        if store is None:
+            return npc.__dict__[self.name]
+        return getattr(store, self.name).item(npc.index)
+
+    def __set__(self, npc, value):
+        store = npc.store
+        if store is None:
+            npc.__dict__[self.name] = value
+        else:
+            getattr(store, self.name)[npc.index] = value
+
+# All (mover, obstacle) index pairs whose top-left cells, in a grid of
+# cell_size, differ by one of the given offsets on each axis. Obstacles are
+# counting-sorted by cell so each lookup is a gather, not a search.
+def grid_pairs(mover_x, mover_y, obstacle_x, obstacle_y, cell_size, offsets):
+    obstacle_cx = np.floor_divide(obstacle_x, cell_size).astype('int64')
+    obstacle_cy = np.floor_divide(obstacle_y, cell_size).astype('int64')
+    mover_cx = np.floor_divide(mover_x, cell_size).astype('int64')
+    mover_cy = np.floor_divide(mover_y, cell_size).astype('int64')
+    min_cx = min(obstacle_cx.min(), mover_cx.min() + min(offsets))
+    min_cy = min(obstacle_cy.min(), mover_cy.min() + min(offsets))
+    columns = max(obstacle_cx.max(), mover_cx.max() + max(offsets)) - min_cx + 1
+    rows = max(obstacle_cy.max(), mover_cy.max() + max(offsets)) - min_cy + 1
+    keys = (obstacle_cx - min_cx) * rows + (obstacle_cy - min_cy)
+    order = np.argsort(keys, kind='stable')
+    cell_start = np.zeros(columns * rows + 1, dtype='int64')
+    np.cumsum(np.bincount(keys, minlength=columns * rows), out=cell_start[1:])
+    positions = np.arange(mover_x.size)
+    pair_mover = []
+    pair_obstacle = []
+    for offset_x in offsets:
+        for offset_y in offsets:
+            cell_keys = (mover_cx + offset_x - min_cx) * rows + (mover_cy + offset_y - min_cy)
+            start = cell_start[cell_keys]
+            counts = cell_start[cell_keys + 1] - start
+            total = counts.sum()
+            if total:
+                first = np.cumsum(counts) - counts
+                pair_mover.append(np.repeat(positions, counts))
+                pair_obstacle.append(order[np.arange(total) - np.repeat(first - start, counts)])
+    if not pair_mover:
+        return None
+    return np.concatenate(pair_mover), np.concatenate(pair_obstacle)
+
+# Struct-of-arrays storage for NPC simulation state. Wandering, fleeing,
+# walkability checks, NPC-NPC collision and animation for every stored NPC
+# run as NumPy vector operations in step(); the NPC objects are thin views
+# used for rendering, combat and pathing.
+class EntityStore:
+    FIELDS = (
+        ('x', 'float64'), ('y', 'float64'), ('direction', 'int32'), ('speed', 'int32'),
+        ('hp', 'int32'), ('alive', 'bool'), ('fleeing', 'bool'), ('flee_timer', 'int32'),
+        ('frame', 'int32'), ('frame_counter', 'int32'), ('moving', 'bool'),
+        ('tile_size', 'int32'), ('frame_count', 'int32'), ('kind', 'int32'),
+        ('scripted', 'bool'),  # Moved by NPC.update (e.g. following a path) instead of step()
+        ('lod_wait', 'int64'),  # Ticks since LodScheduler last had the NPC stepped
+    )
+    # Movement per unit of speed for directions 0 (up), 1 (left), 2 (down) and 3 (right)
+    DIRECTION_DX = (0, -1, 0, 1)
+    DIRECTION_DY = (-1, 0, 1, 0)
+
+    def __init__(self, seed=None, capacity=256):
+        if np is None:
+            raise ImportError("EntityStore requires NumPy")
+        self.count = 0
+        self.capacity = capacity
+        self.npcs = []
+        for name, dtype in self.FIELDS:
+            setattr(self, name, np.zeros(capacity, dtype=dtype))
+        self.direction_dx = np.array(self.DIRECTION_DX)
+        self.direction_dy = np.array(self.DIRECTION_DY)
+        self.rng = np.random.default_rng(seed)
+
+    def __len__(self):
+        return self.count
+
+    def add(self, npc):
+        if self.count == self.capacity:
+            self.capacity *= 2
+            for name, _ in self.FIELDS:
+                array = getattr(self, name)
+                grown = np.zeros(self.capacity, dtype=array.dtype)
+                grown[:self.count] = array[:self.count]
+                setattr(self, name, grown)
+        index = self.count
+        self.count += 1
+        self.npcs.append(npc)
+        # The slot may have belonged to a removed NPC
+        for name, _ in self.FIELDS:
+            getattr(self, name)[index] = 0
+        self.tile_size[index] = npc.tile_size
+        self.frame_count[index] = npc.frame_count
+        return index
+
+    # Drop the NPC at index, moving the last NPC into its place so the live
+    # range stays packed
+    def remove(self, index):
+        last = self.count - 1
+        if index != last:
+            for name, _ in self.FIELDS:
+                array = getattr(self, name)
+                array[index] = array[last]
+            moved = self.npcs[index] = self.npcs[last]
+            moved.index = index
+        self.npcs.pop()
+        self.count = last
+
+    # Advance every live, unscripted NPC by one tick. obstacles is a list of
+    # (x, y, size) squares for NPCs outside the store that still block others.
+    # mask limits the step to some NPCs, dt, an array of tick counts, makes
+    # each of them cover that many ticks at once and collide limits the NPCs
+    # that check for collisions with others (see LodScheduler).
+    def step(self, game_map, obstacles=(), profiler=NULL_PROFILER, mask=None, dt=None, collide=None):
+        n = self.count
+        if n == 0:
+            return
+        turn_roll, turn_direction, flee_speed = self.draw_randoms(n)
+        active, was_fleeing = self.begin_step(n, mask)
+        self.step_flee(game_map, np.flatnonzero(was_fleeing), flee_speed, dt)
+        wander_index = np.flatnonzero(active & ~was_fleeing)
+        self.step_wander(game_map, wander_index, turn_roll, turn_direction, obstacles, profiler, dt=dt, collide=collide)
+        self.step_animation(active, dt)
+
+    # Draw every random number up front so results only depend on the seed
+    def draw_randoms(self, n):
+        rng = self.rng
+        turn_roll = rng.random(n)
+        turn_direction = rng.integers(0, 4, n)
+        flee_speed = rng.integers(3, 11, n)
+        return turn_roll, turn_direction, flee_speed
+
+    # Masks of the NPCs step() moves this tick, and of those that start it fleeing
+    def begin_step(self, n, mask=None):
+        active = self.alive[:n] & ~self.scripted[:n]
+        if mask is not None:
+            active &= mask
+        self.moving[:n][active] = False
+        was_fleeing = self.fleeing[:n] & active
+        return active, was_fleeing
+
+    # Fleeing NPCs run at a random speed, trying straight on, then each side
+    def step_flee(self, game_map, flee_index, flee_speed, dt=None):
+        if flee_index.size == 0:
+            return
+        x, y, direction = self.x, self.y, self.direction
+        ticks = 1 if dt is None else dt[flee_index]
+        timer = self.flee_timer[flee_index] + ticks
+        flee_step = flee_speed[flee_index]
+        calmed = timer >= NPC_MAX_FLEE_TIME
+        flee_step[calmed] = 1
+        timer[calmed] = 0
+        self.fleeing[flee_index[calmed]] = False
+        self.flee_timer[flee_index] = timer
+        self.speed[flee_index] = flee_step
+        flee_step = flee_step * ticks
+
+        size = self.tile_size[flee_index]
+        current = direction[flee_index]
+        chosen = np.full(flee_index.size, -1)
+        for candidate in (current, (current + 1) % 4, (current - 1) % 4):
+            new_x = x[flee_index] + self.direction_dx[candidate] * flee_step
+            new_y = y[flee_index] + self.direction_dy[candidate] * flee_step
+            take = (chosen < 0) & game_map.walkable_mask(new_x, new_y, size)
+            chosen[take] = candidate[take]
+        escaped = chosen >= 0
+        movers = flee_index[escaped]
+        x[movers] += self.direction_dx[chosen[escaped]] * flee_step[escaped]
+        y[movers] += self.direction_dy[chosen[escaped]] * flee_step[escaped]
+        direction[movers] = chosen[escaped]
+        self.moving[movers] = True
+
+    # Wandering NPCs occasionally turn, then step unless blocked.
+    # obstacle_range limits which stored NPCs are considered as obstacles
+    # (see first_overlaps); out, an (x, y) pair of arrays, receives the new
+    # positions instead of self.x and self.y. NPCs left out of the collide
+    # mask only check the map, not each other.
+    def step_wander(self, game_map, wander_index, turn_roll, turn_direction, obstacles=(), profiler=NULL_PROFILER, obstacle_range=None, out=None, dt=None, collide=None):
+        if wander_index.size == 0:
+            return
+        x, y, direction, speed = self.x, self.y, self.direction, self.speed
+        if dt is None:
+            turning = wander_index[turn_roll[wander_index] < 0.01]
+            distance = speed[wander_index]
+        else:
+            # The chance of turning at least once over dt ticks
+            ticks = dt[wander_index]
+            turning = wander_index[turn_roll[wander_index] < 1 - 0.99 ** ticks]
+            distance = speed[wander_index] * ticks
+        direction[turning] = turn_direction[turning]
+        new_x = x[wander_index] + self.direction_dx[direction[wander_index]] * distance
+        new_y = y[wander_index] + self.direction_dy[direction[wander_index]] * distance
+        walkable = game_map.walkable_mask(new_x, new_y, self.tile_size[wander_index])
+        profiler.lap('npc_update')
+        if collide is None:
+            collided, overlap_area = self.first_overlaps(wander_index, new_x, new_y, obstacles, obstacle_range)
+        else:
+            checked = collide[wander_index]
+            collided = np.zeros(wander_index.size, dtype=bool)
+            overlap_area = np.zeros(wander_index.size, dtype='int64')
+            collided[checked], overlap_area[checked] = self.first_overlaps(wander_index[checked], new_x[checked], new_y[checked], obstacles, obstacle_range)
+        profiler.lap('collision')
+        # Like NPC.update, a deep overlap lets the NPC push through
+        allowed = walkable & (~collided | (overlap_area > 200))
+        movers = wander_index[allowed]
+        x, y = out or (x, y)
+        x[movers] = new_x[allowed]
+        y[movers] = new_y[allowed]
+        self.moving[movers] = True
+
+    def step_animation(self, active, dt=None):
+        animated = np.flatnonzero(active)
+        frame_counter = self.frame_counter
+        if dt is not None:
+            # Several ticks at once can pass more than one animation step
+            frame_counter[animated] += dt[animated]
+            steps = frame_counter[animated] // NPC_ANIMATION_SPEED
+            frame_counter[animated] %= NPC_ANIMATION_SPEED
+            moving = self.moving[animated]
+            self.frame[animated[moving]] = (self.frame[animated[moving]] + steps[moving]) % self.frame_count[animated[moving]]
+            return
+        frame_counter[animated] += 1
+        advance = animated[frame_counter[animated] >= NPC_ANIMATION_SPEED]
+        frame_counter[advance] = 0
+        advance = advance[self.moving[advance]]
+        self.frame[advance] = (self.frame[advance] + 1) % self.frame_count[advance]
+
+    # For each mover (with proposed top-left new_x, new_y), find the first
+    # live NPC or obstacle its rect would overlap. Returns (collided,
+    # overlap_area) arrays aligned with movers. obstacle_range, an (x_min,
+    # x_max) pair, skips stored NPCs whose left edge lies outside it.
+    def first_overlaps(self, movers, new_x, new_y, obstacles, obstacle_range=None):
+        n = self.count
+        collided = np.zeros(movers.size, dtype=bool)
+        overlap_area = np.zeros(movers.size, dtype='int64')
+        if movers.size == 0:
+            return collided, overlap_area
+        alive = np.flatnonzero(self.alive[:n])
+        if obstacle_range is not None:
+            left = np.trunc(self.x[alive])
+            alive = alive[(left >= obstacle_range[0]) & (left < obstacle_range[1])]
+        obstacle_x = np.trunc(self.x[alive])
+        obstacle_y = np.trunc(self.y[alive])
+        obstacle_size = self.tile_size[alive]
+        obstacle_id = alive
+        if obstacles:
+            extra = np.array(obstacles, dtype='float64').reshape(-1, 3)
+            obstacle_x = np.concatenate((obstacle_x, np.trunc(extra[:, 0])))
+            obstacle_y = np.concatenate((obstacle_y, np.trunc(extra[:, 1])))
+            obstacle_size = np.concatenate((obstacle_size, extra[:, 2].astype('int32')))
+            obstacle_id = np.concatenate((obstacle_id, n + np.arange(len(extra))))
+
+        # Only obstacles touching the movers' bounding box can be hit
+        mover_x = np.trunc(new_x)
+        mover_y = np.trunc(new_y)
+        mover_size = self.tile_size[movers]
+        near = ((obstacle_x + obstacle_size > mover_x.min()) & (obstacle_x < (mover_x + mover_size).max()) &
+                (obstacle_y + obstacle_size > mover_y.min()) & (obstacle_y < (mover_y + mover_size).max()))
+        if not near.all():
+            obstacle_x, obstacle_y = obstacle_x[near], obstacle_y[near]
+            obstacle_size, obstacle_id = obstacle_size[near], obstacle_id[near]
+        if obstacle_id.size == 0:
+            return collided, overlap_area
+
+        # Broad phase per (obstacle size, mover size) class: obstacles are
+        # bucketed in cells as large as themselves, so a mover of size M can
+        # only overlap obstacles whose top-left cell is within -1..ceil(M / S)
+        # cells of its own
+        pair_mover = []
+        pair_obstacle = []
+        for cell_size in np.unique(obstacle_size):
+            members = np.flatnonzero(obstacle_size == cell_size)
+            cell_size = int(cell_size)
+            for size_class in np.unique(mover_size):
+                group = np.flatnonzero(mover_size == size_class)
+                reach = -(-int(size_class) // cell_size)
+                pairs = grid_pairs(mover_x[group], mover_y[group], obstacle_x[members], obstacle_y[members], cell_size, range(-1, reach + 1))
+                if pairs is not None:
+                    pair_mover.append(group[pairs[0]])
+                    pair_obstacle.append(members[pairs[1]])
+        if not pair_mover:
+            return collided, overlap_area
+        pair_mover = np.concatenate(pair_mover)
+        pair_obstacle = np.concatenate(pair_obstacle)
+        keep = obstacle_id[pair_obstacle] != movers[pair_mover]
+        pair_mover, pair_obstacle = pair_mover[keep], pair_obstacle[keep]
+
+        mover_size = mover_size[pair_mover]
+        left = np.maximum(mover_x[pair_mover], obstacle_x[pair_obstacle])
+        right = np.minimum(mover_x[pair_mover] + mover_size, obstacle_x[pair_obstacle] + obstacle_size[pair_obstacle])
+        top = np.maximum(mover_y[pair_mover], obstacle_y[pair_obstacle])
+        bottom = np.minimum(mover_y[pair_mover] + mover_size, obstacle_y[pair_obstacle] + obstacle_size[pair_obstacle])
+        hit = (right > left) & (bottom > top)
+        if not hit.any():
+            return collided, overlap_area
+        pair_mover, pair_obstacle = pair_mover[hit], pair_obstacle[hit]
+        area = ((right - left) * (bottom - top))[hit].astype('int64')
+
+        # Keep the lowest-numbered obstacle for each mover
+        first_hit = np.lexsort((obstacle_id[pair_obstacle], pair_mover))
+        pair_mover, area = pair_mover[first_hit], area[first_hit]
+        unique_movers, first_index = np.unique(pair_mover, return_index=True)
+        collided[unique_movers] = True
+        overlap_area[unique_movers] = area[first_index]
+        return collided, overlap_area
+
+# Multi-process EntityStore stepping. The store's arrays live in shared
+# memory; every tick the map is cut into vertical strips by the NPCs'
+# positions at the start of the tick, and a process pool runs step_flee and
+# then step_wander for each strip. Workers see the whole store, so NPCs
+# crossing a strip border are simply picked up by their new strip next tick;
+# collision checks only look at NPCs within reach of the strip.
+#
+# Every update reads positions from the start of its phase (Jacobi style:
+# wandering NPCs check collisions against a snapshot taken after fleeing),
+# all random numbers are drawn in the main process in the same order as
+# EntityStore.step, and collisions resolve by global NPC index, so the
+# result is identical to the single-process step for any worker count.
+SHARD_SCRATCH_FIELDS = (
+    ('turn_roll', 'float64'), ('turn_direction', 'int64'), ('flee_speed', 'int64'),
+    ('was_fleeing', 'bool'), ('active', 'bool'), ('order', 'int64'),
+    ('start_x', 'float64'), ('start_y', 'float64'), ('dt', 'int64'), ('collide', 'bool'),
+)
+
+# Offsets of every store field and scratch array in the shared block
+def shard_layout(capacity):
+    layout = []
+    offset = 0
+    for name, dtype in EntityStore.FIELDS + SHARD_SCRATCH_FIELDS:
+        itemsize = np.dtype(dtype).itemsize
+        offset = -(-offset // itemsize) * itemsize
+        layout.append((name, dtype, offset))
+        offset += itemsize * capacity
+    return layout, offset
+
+def shard_views(buffer, capacity):
+    layout, _ = shard_layout(capacity)
+    return {name: np.ndarray(capacity, dtype=dtype, buffer=buffer, offset=offset) for name, dtype, offset in layout}
+
+# The part of Map that stepping needs, cheap to send to workers
+class WalkableGrid:
+    def __init__(self, walkable, width, height):
+        self.walkable = walkable
+        self.width = width
+        self.height = height
+
+    walkable_mask = Map.walkable_mask
+
+# Worker process state: the grid from the pool initializer and the currently
+# attached shared block
+shard_grid = None
+shard_block = None
+
+def shard_worker_init(walkable, width, height):
+    global shard_grid
+    shard_grid = WalkableGrid(walkable, width, height)
+
+def shard_worker_store(name, capacity, n):
+    global shard_block
+    if shard_block is None or shard_block[0].name != name:
+        if shard_block is not None:
+            shard_block[0].close()
+        block = shared_memory.SharedMemory(name=name)
+        shard_block = (block, shard_views(block.buf, capacity))
+    store = EntityStore.__new__(EntityStore)
+    store.count = n
+    store.capacity = capacity
+    store.direction_dx = np.array(EntityStore.DIRECTION_DX)
+    store.direction_dy = np.array(EntityStore.DIRECTION_DY)
+    for field, view in shard_block[1].items():
+        setattr(store, field, view)
+    return store
+
+# One strip of one phase: task is (block name, capacity, count, phase,
+# start, end, x_min, x_max, obstacles, scaled); start:end is the strip's
+# slice of the order array and scaled says whether the dt and collide
+# arrays are in use
+def shard_worker_step(task):
+    name, capacity, n, phase, start, end, x_min, x_max, obstacles, scaled = task
+    store = shard_worker_store(name, capacity, n)
+    index = np.sort(store.order[start:end])
+    dt, collide = (store.dt, store.collide) if scaled else (None, None)
+    if phase == 'flee':
+        store.step_flee(shard_grid, index[store.was_fleeing[index]], store.flee_speed, dt)
+    else:
+        x, y = store.x, store.y
+        store.x, store.y = store.start_x, store.start_y
+        wander_index = index[store.active[index] & ~store.was_fleeing[index]]
+        store.step_wander(shard_grid, wander_index, store.turn_roll, store.turn_direction, obstacles,
+                          obstacle_range=(x_min, x_max), out=(x, y), dt=dt, collide=collide)
+
+class ShardedStepper:
+    def __init__(self, store, game_map, workers, strips=None):
+        self.store = store
+        self.workers = workers
+        self.strips = strips or workers * 2
+        self.map_width = game_map.width * TILE_SIZE
+        self.block = None
+        self.capacity = 0
+        # SDL turns SIGTERM into a quit event; keep it out of the workers so
+        # the pool can always be shut down
+        os.environ['SDL_NO_SIGNAL_HANDLERS'] = '1'
+        context = multiprocessing.get_context('spawn')
+        self.pool = context.Pool(workers, shard_worker_init, (bytes(game_map.walkable), game_map.width, game_map.height))
+
+    # Move the store's arrays into a fresh shared block (again after the
+    # store has grown)
+    def share(self):
+        store = self.store
+        _, nbytes = shard_layout(store.capacity)
+        block = shared_memory.SharedMemory(create=True, size=nbytes)
+        self.views = shard_views(block.buf, store.capacity)
+        for name, _ in EntityStore.FIELDS:
+            self.views[name][:store.count] = getattr(store, name)[:store.count]
+            setattr(store, name, self.views[name])
+        self.release()
+        self.block = block
+        self.capacity = store.capacity
+
+    def release(self):
+        if self.block is not None:
+            self.block.close()
+            self.block.unlink()
+            self.block = None
+
+    def step(self, game_map, obstacles=(), profiler=NULL_PROFILER, mask=None, dt=None, collide=None):
+        store = self.store
+        n = store.count
+        if n == 0:
+            return
+        if store.capacity != self.capacity or store.x is not self.views['x']:
+            self.share()
+        views = self.views
+        turn_roll, turn_direction, flee_speed = store.draw_randoms(n)
+        active, was_fleeing = store.begin_step(n, mask)
+        if dt is not None:
+            views['dt'][:n] = dt
+            views['collide'][:n] = collide
+        views['turn_roll'][:n] = turn_roll
+        views['turn_direction'][:n] = turn_direction
+        views['flee_speed'][:n] = flee_speed
+        views['active'][:n] = active
+        views['was_fleeing'][:n] = was_fleeing
+
+        # Strip of each NPC from where it starts the tick
+        strip_width = -(-self.map_width // self.strips)
+        strip = np.clip(np.trunc(store.x[:n]).astype('int64') // strip_width, 0, self.strips - 1)
+        views['order'][:n] = np.argsort(strip, kind='stable')
+        bounds = np.searchsorted(strip, np.arange(self.strips + 1), sorter=views['order'][:n])
+
+        # An obstacle can reach into a strip by its own size plus the distance
+        # a mover covers in one step
+        ticks = 1 if dt is None else int(dt[active].max(initial=1))
+        margin = int(store.tile_size[:n].max()) + int(store.speed[:n][active].max(initial=0)) * ticks + 1
+        obstacles = [tuple(obstacle) for obstacle in obstacles]
+        for phase in ('flee', 'wander'):
+            if phase == 'wander':
+                views['start_x'][:n] = store.x[:n]
+                views['start_y'][:n] = store.y[:n]
+            tasks = []
+            for i in range(self.strips):
+                if bounds[i] < bounds[i + 1]:
+                    tasks.append((self.block.name, self.capacity, n, phase, int(bounds[i]), int(bounds[i + 1]),
+                                  i * strip_width - margin, (i + 1) * strip_width + margin, obstacles, dt is not None))
+            self.pool.map(shard_worker_step, tasks)
+            profiler.lap('npc_update' if phase == 'flee' else 'collision')
+
+        store.step_animation(active, dt)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        # Hand the store private copies before the shared block goes away
+        store = self.store
+        if self.block is not None:
+            for name, _ in EntityStore.FIELDS:
+                setattr(store, name, getattr(store, name).copy())
+        self.release()
+
+# Decides which stored NPCs EntityStore.step moves each tick. NPCs near the
+# camera's view tick every frame; further out they tick every mid_interval
+# or far_interval frames and cover all the skipped ticks in one step. The
+# near band extends well past the view, so the coarser steps and any change
+# of tier happen off screen. Each NPC's turn is staggered by its index, so
+# about the same number of NPCs are due on every frame.
+class LodScheduler:
+    def __init__(self, near_margin=LOD_NEAR_MARGIN, mid_margin=LOD_MID_MARGIN, mid_interval=LOD_MID_INTERVAL, far_interval=LOD_FAR_INTERVAL):
+        self.near_margin = near_margin
+        self.mid_margin = mid_margin
+        self.mid_interval = mid_interval
+        self.far_interval = far_interval
+        self.tier_counts = (0, 0, 0)
+
+    # Returns (mask, dt, collide) for EntityStore.step at tick, with camera
+    # the view rect in world coordinates
+    def schedule(self, store, camera, tick):
+        n = store.count
+        x = store.x[:n]
+        y = store.y[:n]
+        size = store.tile_size[:n]
+        # Distance between each NPC's rect and the view, 0 when on screen
+        gap_x = np.maximum(np.maximum(camera.left - (x + size), x - camera.right), 0)
+        gap_y = np.maximum(np.maximum(camera.top - (y + size), y - camera.bottom), 0)
+        gap = np.maximum(gap_x, gap_y)
+        fleeing = store.fleeing[:n]
+        near = (gap <= self.near_margin) | fleeing  # Fleeing NPCs are fast; keep them exact
+        mid = ~near & (gap <= self.mid_margin)
+        interval = np.where(near, 1, np.where(mid, self.mid_interval, self.far_interval))
+        due = (tick + np.arange(n)) % interval == 0
+        # After a change of tier (or of index), catch up on the ticks since
+        # the last step. Not when fleeing: step_flee checks only where a step
+        # lands, so a multi-tick flee step could jump over water
+        wait = store.lod_wait[:n]
+        wait += 1
+        dt = np.where(fleeing, 1, np.minimum(wait, self.far_interval))
+        wait[due] = 0
+        self.tier_counts = (int(near.sum()), int(mid.sum()), n - int(near.sum()) - int(mid.sum()))
+        return due, dt, near | mid
+
 class NPC:
-    def __init__(self, x, y, tileset, tile_size, frame_count, speed, blood_splat_frames):
-        self.x = x
-        self.y = y
-        self.tileset = tileset
+    x = StoreField()
+    y = StoreField()
+    direction = StoreField()
+    speed = StoreField()
+    hp = StoreField()
+    alive = StoreField()
+    fleeing = StoreField()
+    flee_timer = StoreField()
+    frame = StoreField()
+    frame_counter = StoreField()
+    moving = StoreField()
+
+    def __init__(self, x, y, tileset, tile_size, frame_count, speed, blood_splat_frames, store=None):
+        self.store = store
         self.tile_size = tile_size
         self.frame_count = frame_count
-        self.speed = speed
+        self.tileset = tileset
+        self.walk_speed = speed
+        self.animation_speed = NPC_ANIMATION_SPEED
+        self.frames = self.load_frames()
+        self.blood_splat_frames = blood_splat_frames
+        self.splats = None  # World's set of NPCs with a running splat
+        self.entities = None  # EntityManager that recycles this NPC
+        self.blood_splat_animations = get_blood_splat_animations(blood_splat_frames)
+        self.max_flee_time = NPC_MAX_FLEE_TIME
+        self.spatial_hash = None
+        self.slot = None  # Place in EntityManager.entities
+        self.generation = 0  # Lives so far; see EntityManager
+        self.reset(x, y)
+
+    # Bring the NPC (back) to life at (x, y) with fresh state
+    def reset(self, x, y):
+        if self.store is not None:
+            self.index = self.store.add(self)
+        self.x = x
+        self.y = y
+        self.speed = self.walk_speed
         self.direction = random.choice([0, 1, 2, 3])
         self.frame = 0
         self.frame_counter = 0
-        self.animation_speed = 10
-        self.frames = self.load_frames()
         self.hp = 100
         self.alive = True
         self.blood_splat_timer = 0
-        self.blood_splat_frames = blood_splat_frames
         self.blood_splat_frame = 0
         self.show_blood_splat = False
         self.blood_splat_offset_x = 0
@@ -241,26 +1905,49 @@ class NPC:
         self.scaled_blood_splat_frames = []
         self.fleeing = False
         self.flee_timer = 0
-        self.max_flee_time = 60
         self.moving = False
         self.path = []
-        self.target = None  # Add a target attribute
+        self.target = None  # Handle of the NPC being chased
+
+    # Names this life of the NPC; see EntityManager
+    @property
+    def handle(self):
+        return (self.slot, self.generation)
 
     def load_frames(self):
-        frames = [[], [], [], []]
-        for direction in range(4):
-            for frame in range(self.frame_count):
-                rect = pygame.Rect(frame * self.tile_size, direction * self.tile_size, self.tile_size, self.tile_size)
-                frames[direction].append(self.tileset.subsurface(rect))
-        return frames
-
-    def update(self, map_data, other_npcs, character_rect):
+        return get_sprite_frames(self.tileset, self.tile_size, self.tile_size, self.frame_count)
+
+    # Waypoints being followed; while set, a stored NPC is moved by update()
+    # rather than by EntityStore.step()
+    @property
+    def path(self):
+        return self._path
+
+    @path.setter
+    def path(self, path):
+        self._path = path
+        if self.store is not None:
+            self.store.scripted[self.index] = bool(path)
+
+    def move_to(self, x, y):
+        self.x, self.y = x, y
+        if self.spatial_hash is not None:
+            self.spatial_hash.move(self)
+
+    # profiler gets the NPC-NPC collision checks lapped as 'collision'
+    def update(self, map_data, npc_index, character_rect, profiler=NULL_PROFILER):
         self.map_data = map_data
+        self.update_blood_splat()
         if not self.alive:
             return
+        self.update_movement(map_data, npc_index, profiler)
+        self.update_animation()
 
+    def update_movement(self, map_data, npc_index, profiler=NULL_PROFILER):
         self.moving = False
-        if self.fleeing:
+        if self.path and not self.fleeing:
+            self.follow_path(self.speed * 2)
+        elif self.fleeing:
             self.flee_timer += 1
             self.speed = random.randint(3, 10)
             if self.flee_timer >= self.max_flee_time:
@@ -279,9 +1966,8 @@ class NPC:
                 elif direction == 3:
                     new_x += self.speed
 
-                new_rect = pygame.Rect(new_x, new_y, self.tile_size, self.tile_size)
                 if map_data.is_walkable(int(new_x), int(new_y), self.tile_size, self.tile_size):
-                    self.x, self.y = new_x, new_y
+                    self.move_to(new_x, new_y)
                     self.direction = direction
                     self.moving = True
                     break
@@ -299,71 +1985,98 @@ class NPC:
             elif self.direction == 1:
                 new_x -= self.speed
 
+            profiler.lap('npc_update')
             new_rect = pygame.Rect(new_x, new_y, self.tile_size, self.tile_size)
             collision = False
             overlap_area = 0
 
-            for other_npc in other_npcs:
-                if other_npc != self:
-                    if new_rect.colliderect(other_npc.get_rect()):
-                        overlap_rect = new_rect.clip(other_npc.get_rect())
-                        overlap_area = overlap_rect.width * overlap_rect.height
-                        collision = True
-                        #print(f"Collision with NPC, overlap area: {overlap_area}")
+            for other_npc in npc_index.query(new_rect, exclude=self):
+                overlap_rect = new_rect.clip(other_npc.get_rect())
+                overlap_area = overlap_rect.width * overlap_rect.height
+                collision = True
+                #print(f"Collision with NPC, overlap area: {overlap_area}")
 
-                        if overlap_area > 200 and map_data.is_walkable(int(new_x), int(new_y), self.tile_size, self.tile_size):
-                            self.x, self.y = new_x, new_y
-                            self.moving = True
-                        break
+                if overlap_area > 200 and map_data.is_walkable(int(new_x), int(new_y), self.tile_size, self.tile_size):
+                    self.move_to(new_x, new_y)
+                    self.moving = True
+                break
 
             if not collision and map_data.is_walkable(int(new_x), int(new_y), self.tile_size, self.tile_size):
-                self.x, self.y = new_x, new_y
+                self.move_to(new_x, new_y)
                 self.moving = True
+            profiler.lap('collision')
 
+    def update_animation(self):
         self.frame_counter += 1
         if self.frame_counter >= self.animation_speed:
             self.frame_counter = 0
             if self.moving:
                 self.frame = (self.frame + 1) % self.frame_count
 
-    def draw(self, screen, offset_x, offset_y):
-        if self.alive:
-            screen.blit(self.frames[self.direction][self.frame], (self.x - offset_x, self.y - offset_y))
-
+    # Step towards the next waypoint in self.path, dropping it once reached
+    def follow_path(self, speed):
+        target_x, target_y = self.path[0]
+        dx = target_x - self.x
+        dy = target_y - self.y
+        distance_sq = dx * dx + dy * dy
+        if distance_sq <= speed * speed:
+            self.move_to(target_x, target_y)
+            self.path.pop(0)
+            if not self.path:
+                self.path = []
+        else:
+            distance = distance_sq ** 0.5
+            self.move_to(self.x + speed * dx / distance, self.y + speed * dy / distance)
+        if abs(dx) > abs(dy):
+            self.direction = 3 if dx > 0 else 1
+        elif dy:
+            self.direction = 2 if dy > 0 else 0
+        self.moving = True
+
+    # Advance the blood splat animation; part of the simulation step so it
+    # also runs when nothing is drawn
+    def update_blood_splat(self):
         if self.show_blood_splat:
-            screen.blit(self.scaled_blood_splat_frames[self.blood_splat_frame], (self.x - offset_x + self.blood_splat_offset_x, self.y - offset_y + self.blood_splat_offset_y))
             self.blood_splat_timer += 1
             if self.blood_splat_timer >= 3:
                 self.blood_splat_timer = 0
                 self.blood_splat_frame += 1
                 if self.blood_splat_frame >= len(self.scaled_blood_splat_frames):
                     self.show_blood_splat = False
+                    self.blood_splat_frame = 0
+                    if self.splats is not None:
+                        self.splats.pop(self, None)
+
+    def image(self):
+        return self.frames[self.direction][self.frame]
+
+    # Current splat frame and its top-left world position
+    def blood_splat_sprite(self):
+        return self.scaled_blood_splat_frames[self.blood_splat_frame], (self.x + self.blood_splat_offset_x, self.y + self.blood_splat_offset_y)
 
     def get_rect(self):
         return pygame.Rect(self.x, self.y, self.tile_size, self.tile_size)
 
-    def take_damage(self, damage, attacker_x, attacker_y, map_surface):
+    def take_damage(self, damage, attacker_x, attacker_y, game_map):
         self.hp -= damage
         if self.hp <= 0:
             self.die()
-            scale_factor = .5
-            draw_blood_puddle(map_surface, blood_puddle_image, self.x, self.y, scale_factor, self.map_data)  # Pass map_data
+            draw_blood_puddle(game_map, assets.image(BLOOD_PUDDLE_FILENAME), self.x, self.y, BLOOD_PUDDLE_SCALE)
 
         self.show_blood_splat = True
         self.blood_splat_frame = 0
+        if self.splats is not None:
+            self.splats[self] = None
         blood_splat_center_x = self.tile_size // 2
         blood_splat_center_y = self.tile_size // 2
         self.blood_splat_offset_x = blood_splat_center_x - (self.blood_splat_frames[0].get_width() // 2)
         self.blood_splat_offset_y = blood_splat_center_y - (self.blood_splat_frames[0].get_height() // 2)
 
-        scale_factor = random.uniform(1, 2)
-        self.scaled_blood_splat_frames = [
-            pygame.transform.scale(frame, (int(frame.get_width() * scale_factor), int(frame.get_height() * scale_factor)))
-            for frame in self.blood_splat_frames
-        ]
+        self.scaled_blood_splat_frames = random.choice(self.blood_splat_animations)
 
         self.fleeing = True
         self.flee_timer = 0
+        self.path = []
         if attacker_x < self.x:
             self.direction = 3
         elif attacker_x > self.x:
@@ -378,13 +2091,20 @@ class NPC:
     def die(self):
         self.alive = False
         self.blood_splat_timer = 0
+        if self.spatial_hash is not None:
+            self.spatial_hash.remove(self)
+        if self.entities is not None:
+            self.entities.dying.append(self)
 
-    def attack(self, target, map_surface):
+    def attack(self, target, game_map):
         if target.hp > 0:
-            target.take_damage(10, self.x, self.y, map_surface)
+            target.take_damage(10, self.x, self.y, game_map)
 
-    def chase(self, target, map_surface):
+    def chase(self, target, game_map, pathfinder=None):
         if self.alive and target.alive:
+            if target.handle != self.target:
+                self.target = target.handle
+                self.path = []
             self_center_x = self.x + self.tile_size // 2
             self_center_y = self.y + self.tile_size // 2
             target_center_x = target.x + target.tile_size // 2
@@ -392,38 +2112,54 @@ class NPC:
 
             dx = target_center_x - self_center_x
             dy = target_center_y - self_center_y
-            distance = (dx ** 2 + dy ** 2) ** 0.5
+            distance_sq = dx * dx + dy * dy
 
-            if distance < 200:
-                if distance > target.tile_size:
+            if distance_sq < PIG_CHASE_RADIUS * PIG_CHASE_RADIUS:
+                distance = distance_sq ** 0.5
+                if distance > target.tile_size and not self.path:
                     step_x = self.speed * dx / distance * 2
                     step_y = self.speed * dy / distance * 2
                     new_x = self.x + step_x
                     new_y = self.y + step_y
 
-                    if self.map_data.is_walkable(int(new_x), int(new_y), self.tile_size, self.tile_size):
-                        self.x, self.y = new_x, new_y
+                    if game_map.is_walkable(int(new_x), int(new_y), self.tile_size, self.tile_size):
+                        self.move_to(new_x, new_y)
                         if abs(dx) > abs(dy):
                             self.direction = 3 if dx > 0 else 1
                         else:
                             self.direction = 2 if dy > 0 else 0
                         self.moving = True
+                    elif pathfinder is not None:
+                        # Blocked (e.g. by water), route around it; update() follows the path
+                        pathfinder.request(self, target_center_x, target_center_y)
                 if distance < target.tile_size:
-                    self.attack(target, map_surface)
+                    self.attack(target, game_map)
+
+    def hunt(self, prey_index, game_map, pathfinder=None):
+        if self.alive:
+            target = prey_index.nearest(self.x, self.y, PIG_CHASE_RADIUS)
+            if target is not None:
+                self.chase(target, game_map, pathfinder)
 
 # Function to check if position is valid for NPC placement
-def is_position_valid(x, y, npcs, map_data):
-    new_rect = pygame.Rect(x, y, TILE_SIZE, TILE_SIZE)
-    if any(new_rect.colliderect(npc.get_rect()) for npc in npcs):
+def is_position_valid(x, y, npc_index, map_data, size=TILE_SIZE):
+    new_rect = pygame.Rect(x, y, size, size)
+    if npc_index.query(new_rect):
         return False
-    return map_data.is_walkable(x, y, TILE_SIZE, TILE_SIZE)
+    return map_data.is_walkable(x, y, size, size)
 
-def loading_screen(screen):
-    font = pygame.font.SysFont('Arial', 36)
-    loading_text = font.render("Loading...", True, (255, 255, 255))
+# Loading message with a progress bar when progress (0..1) is given. Pumps
+# the event queue so the window stays responsive while loading.
+def loading_screen(screen, font, progress=None, label="Loading..."):
+    loading_text = font.render(label, True, (255, 255, 255))
     screen.fill((0, 0, 0))
     screen.blit(loading_text, (SCREEN_WIDTH // 2 - loading_text.get_width() // 2, SCREEN_HEIGHT // 2 - loading_text.get_height() // 2))
+    if progress is not None:
+        bar = pygame.Rect(SCREEN_WIDTH // 2 - 200, SCREEN_HEIGHT // 2 + loading_text.get_height(), 400, 16)
+        pygame.draw.rect(screen, (255, 255, 255), bar, 1)
+        pygame.draw.rect(screen, (255, 255, 255), (bar.x, bar.y, int(bar.width * min(progress, 1)), bar.height))
     pygame.display.flip()
+    pygame.event.pump()
 
 # Define the default dialog tree
 template_dialog_tree = {
@@ -467,80 +2203,273 @@ template_dialog_tree = {
     }
 }
 
+# Dialog tree compiled into flat tables. A node is a line the wizard says
+# plus the options the player can pick; an option has its own text and the
+# node it leads to. Strings are interned into one table, identical subtrees
+# (common in generated trees) are stored once, and picking an option is a
+# couple of list lookups.
+#
+# Besides the nested "response"/"options" form of dialog_tree.json, an option
+# may jump to a named top-level node with {"text": ..., "next": "name"}, so a
+# tree can share branches explicitly. Cycles are rejected, since every
+# conversation has to run out and return to "start".
+class DialogGraph:
+    def __init__(self):
+        self.strings = []        # string id -> text
+        self.node_text = []      # node id -> string id
+        self.node_options = []   # node id -> tuple of option ids
+        self.option_text = []    # option id -> string id
+        self.option_target = []  # option id -> node id
+        self.start = 0
+        self.string_ids = {}
+        self.node_ids = {}       # (text id, option ids) -> node id
+        self.option_ids = {}     # (text id, target node id) -> option id
+
+    def intern(self, text):
+        string_id = self.string_ids.get(text)
+        if string_id is None:
+            string_id = self.string_ids[text] = len(self.strings)
+            self.strings.append(sys.intern(text))
+        return string_id
+
+    def add_node(self, text, options):
+        key = (self.intern(text), tuple(options))
+        node = self.node_ids.get(key)
+        if node is None:
+            node = self.node_ids[key] = len(self.node_text)
+            self.node_text.append(key[0])
+            self.node_options.append(key[1])
+        return node
+
+    def add_option(self, text, target):
+        key = (self.intern(text), target)
+        option = self.option_ids.get(key)
+        if option is None:
+            option = self.option_ids[key] = len(self.option_text)
+            self.option_text.append(key[0])
+            self.option_target.append(target)
+        return option
+
+    def text(self, node):
+        return self.strings[self.node_text[node]]
+
+    def options(self, node):
+        return self.node_options[node]
+
+    def option_label(self, option):
+        return self.strings[self.option_text[option]]
+
+    def target(self, option):
+        return self.option_target[option]
+
+# Validate and compile a dialog tree dict into a DialogGraph. Raises
+# ValueError naming the offending path when the tree is malformed.
+def compile_dialog_tree(dialog_tree):
+    if not isinstance(dialog_tree, dict) or not isinstance(dialog_tree.get('start'), dict):
+        raise ValueError("dialog tree has no start node")
+    graph = DialogGraph()
+    named = {}       # top-level node name -> node id
+    visiting = set()  # named nodes on the current path, for cycle detection
+
+    def text_of(value, path):
+        if not isinstance(value, dict) or not isinstance(value.get('text'), str):
+            raise ValueError(f"{path}: missing text")
+        return value['text']
+
+    def compile_options(options, path):
+        if not isinstance(options, list):
+            raise ValueError(f"{path}: options must be a list")
+        option_ids = []
+        for i, option in enumerate(options):
+            option_path = f"{path}[{i}]"
+            label = text_of(option, option_path)
+            if 'next' in option:
+                if not isinstance(option['next'], str):
+                    raise ValueError(f"{option_path}.next: node name must be a string")
+                target = compile_named(option['next'], option_path + '.next')
+            else:
+                response = text_of(option.get('response'), option_path + '.response')
+                target = graph.add_node(response, compile_options(option.get('options', []), option_path + '.options'))
+            option_ids.append(graph.add_option(label, target))
+        return option_ids
+
+    def compile_named(name, path):
+        if name in named:
+            return named[name]
+        if name in visiting:
+            raise ValueError(f"{path}: dialog cycle through {name!r}")
+        if not isinstance(dialog_tree.get(name), dict):
+            raise ValueError(f"{path}: unknown dialog node {name!r}")
+        visiting.add(name)
+        node = dialog_tree[name]
+        node_id = graph.add_node(text_of(node, name), compile_options(node.get('options', []), name + '.options'))
+        visiting.discard(name)
+        named[name] = node_id
+        return node_id
+
+    graph.start = compile_named('start', 'start')
+    return graph
+
 # load default dialog tree from a file
 def load_dialog_tree(filename):
     try:
         with open(filename, 'r') as file:
             dialog_tree = json.load(file)
-            return dialog_tree
+            return compile_dialog_tree(dialog_tree)
     except Exception as e:
         print("Error loading dialog tree:", e)
         return None
 
-default_dialog_tree = load_dialog_tree("dialog_tree.json")
+# Dialog generation is off unless BARNYARD_GENERATE_DIALOG=1. The endpoint
+# can point at any OpenAI-compatible chat completions server (e.g. a local
+# stub); generated trees are cached on disk keyed on the request, so a
+# relaunch reuses them instead of calling out again.
+DIALOG_API_URL = os.getenv("BARNYARD_DIALOG_API_URL", "https://api.openai.com/v1/chat/completions")
+DIALOG_MODEL = os.getenv("BARNYARD_DIALOG_MODEL", "gpt-4o")
+DIALOG_CACHE_DIR = os.getenv("BARNYARD_DIALOG_CACHE", ".dialog_cache")
+DIALOG_API_TIMEOUT = 60
+
+def dialog_generation_enabled():
+    return os.getenv("BARNYARD_GENERATE_DIALOG") == "1"
+
+def dialog_prompt():
+    return f"Generate a dialog tree of an evil wizard npc in a world where the chickens are being attacked by the pigs, but make it like animal farm. Output in json using this structure, make sure there are multiple options: {template_dialog_tree}"
+
+def dialog_cache_filename(prompt, model):
+    key = hashlib.sha256(json.dumps([model, prompt]).encode('utf-8')).hexdigest()
+    return os.path.join(DIALOG_CACHE_DIR, key + '.json')
+
+# Returns the generated dialog tree as a JSON string, or None
+def call_openai_api(api_url=None):
+    if api_url is None:
+        api_url = DIALOG_API_URL
+    prompt = dialog_prompt()
+    cache_filename = dialog_cache_filename(prompt, DIALOG_MODEL)
+    try:
+        with open(cache_filename, 'r') as file:
+            return file.read()
+    except OSError:
+        pass
+
+    # Imported here: it is slow to import and only needed for generation
+    import requests
 
-# Modify the API call function to use the default dialog tree in case of an error
-def call_openai_api():
-    return None
-    api_url = "https://api.openai.com/v1/chat/completions"
     api_key = os.getenv("OPENAI_API_KEY")
-    if api_key is None:
+    headers = {"Content-Type": "application/json"}
+    if api_key is not None:
+        headers["Authorization"] = f"Bearer {api_key}"
+    elif api_url.startswith("https://api.openai.com/"):
         print("API key not found.")
         return None
-
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json"
-    }
     data = {
-        "model": "gpt-4o",
+        "model": DIALOG_MODEL,
         "response_format": {"type": "json_object"},
         "messages": [
             {
                 "role": "user",
-                "content": f"Generate a dialog tree of an evil wizard npc in a world where the chickens are being attacked by the pigs, but make it like animal farm. Output in json using this structure, make sure there are multiple options: {template_dialog_tree}"
+                "content": prompt
             }
         ]
     }
 
     try:
-        response = requests.post(api_url, headers=headers, data=json.dumps(data))
+        response = requests.post(api_url, headers=headers, data=json.dumps(data), timeout=DIALOG_API_TIMEOUT)
         response.raise_for_status()
-        print(response.json()["choices"][0]["message"]["content"])
-        return response.json()["choices"][0]["message"]["content"]
-    except requests.RequestException as e:
+        content = response.json()["choices"][0]["message"]["content"]
+    except (requests.RequestException, KeyError, IndexError, ValueError) as e:
         print("API call failed:", e)
         return None  # Return None in case of failure
 
+    # Only cache valid trees, so a bad response is retried next launch
+    try:
+        compile_dialog_tree(json.loads(content))
+        os.makedirs(DIALOG_CACHE_DIR, exist_ok=True)
+        with open(cache_filename + '.tmp', 'w') as file:
+            file.write(content)
+        os.replace(cache_filename + '.tmp', cache_filename)
+    except (ValueError, OSError) as e:
+        print("Error caching dialog tree:", e)
+    return content
+
+# Runs call_openai_api on a worker thread so the game starts with the
+# default tree; poll() returns the generated tree once, when it is ready.
+# The thread is a daemon so quitting mid-request doesn't wait on the API.
+class DialogGenerator:
+    def __init__(self, api_url=None):
+        self.result = None
+        self.error = None
+        self.thread = threading.Thread(target=self.run, args=(api_url,), name='dialog', daemon=True)
+        self.thread.start()
+
+    def run(self, api_url):
+        try:
+            self.result = self.generate(api_url)
+        except Exception as e:
+            self.error = e
+
+    # Runs on the worker thread: fetch, parse and compile
+    def generate(self, api_url):
+        dialog_tree_json = call_openai_api(api_url)
+        if not dialog_tree_json:
+            return None
+        try:
+            return compile_dialog_tree(json.loads(dialog_tree_json))
+        except json.JSONDecodeError:
+            print("Failed to decode JSON, keeping default dialog tree")
+            print(dialog_tree_json)
+        except ValueError as e:
+            print("Invalid generated dialog tree, keeping default dialog tree:", e)
+        return None
+
+    def poll(self):
+        if self.thread is None or self.thread.is_alive():
+            return None
+        self.thread = None
+        if self.error is not None:
+            print("Error generating dialog tree:", self.error)
+        return self.result
+
+    # Stop delivering results; a running request is abandoned with the process
+    def shutdown(self):
+        self.thread = None
+
 # Adjust the EvilWizard class to initialize with the dialog tree
 class EvilWizard(NPC):
     def __init__(self, x, y, tileset, tile_size, blood_splat_frames, dialog_tree):
         super().__init__(x, y, tileset, tile_size, 3, 1, blood_splat_frames)
-        self.dialog_tree = dialog_tree
-        self.start_dialog = dialog_tree['start']
-        self.current_dialog = self.start_dialog
-        self.current_options = self.start_dialog.get('options', [])
-        self.speech_text = self.current_dialog['text']
-        self.speech_options = self.current_dialog.get('options', [])
+        self.dialog = dialog_tree  # DialogGraph
+        self.current_node = dialog_tree.start
+        self.current_options = dialog_tree.options(self.current_node)
+        self.speech_text = dialog_tree.text(self.current_node)
+        self.speech_options = self.current_options
         self.speech_duration = 180
         self.speech_timer = 0  # Set to 0 to disable by default
+        self.next_dialog = None  # tree to switch to once the conversation ends
         self.end_dialog_timer = None
         self.end_dialog_duration = 500
 
         print(f"Initial dialog: {self.speech_text}")
         for i, option in enumerate(self.speech_options):
-            print(f"Initial Option {i + 1}: {option['text']}")
+            print(f"Initial Option {i + 1}: {dialog_tree.option_label(option)}")
 
+    # Down, left, right, up; only 3 frames per direction
     def load_frames(self):
-        frames = [[], [], [], []]  # Down, left, right, up
-        for direction in range(4):
-            for frame in range(3):  # Only 3 frames per direction
-                rect = pygame.Rect(frame * self.tile_size, direction * 64, self.tile_size, 64)
-                frames[direction].append(self.tileset.subsurface(rect))
-        return frames
+        return get_sprite_frames(self.tileset, self.tile_size, 64, 3)
+
+    # Swap in a new tree (e.g. a generated one). A conversation already under
+    # way finishes on the old tree and restarts on the new one.
+    def set_dialog_tree(self, dialog_tree):
+        if self.current_node != self.dialog.start:
+            self.next_dialog = dialog_tree
+            return
+        self.dialog = dialog_tree
+        self.current_node = dialog_tree.start
+        self.current_options = dialog_tree.options(self.current_node)
+        if self.speech_timer > 0:
+            self.talk(None)
 
     def talk(self, player):
-        self.speech_text = self.current_dialog['text']
+        self.speech_text = self.dialog.text(self.current_node)
         self.speech_options = self.current_options
         self.speech_timer = self.speech_duration  # Set the timer to enable speech
 
@@ -548,281 +2477,824 @@ class EvilWizard(NPC):
         distance = ((self.x - player.x) ** 2 + (self.y - player.y) ** 2) ** 0.5
         return distance < range
 
-    def draw(self, screen, offset_x, offset_y, font):
-        super().draw(screen, offset_x, offset_y)
+    # Speech bubble and dialog timers, drawn on top of every sprite. Returns
+    # the screen rect covered by the bubble, or None.
+    def draw_speech(self, screen, offset_x, offset_y, font):
+        drawn = None
         if self.speech_timer > 0:
-            wrapped_text = self.wrap_text(self.speech_text, font, 500)
-            bubble_width = max(line.get_width() for line in wrapped_text) + 10
-            bubble_height = sum(line.get_height() for line in wrapped_text) + 10
+            key = ('bubble', font, self.speech_text, self.dialog, self.speech_options)
+            bubble, bubble_width, bubble_height = text_cache.get(key, lambda: self.render_bubble(font))
             bubble_x = self.x - offset_x + self.tile_size // 2 - bubble_width // 2
             bubble_y = self.y - offset_y - bubble_height - 10
-            pygame.draw.rect(screen, (0, 0, 0), (bubble_x, bubble_y, bubble_width, bubble_height))  # White background
-            pygame.draw.rect(screen, (255, 255, 255), (bubble_x, bubble_y, bubble_width, bubble_height), 2)  # Black border
-
-            text_y = bubble_y + 5
-            for line in wrapped_text:
-                screen.blit(line, (bubble_x + 5, text_y))
-                text_y += line.get_height()
-
-            option_y = bubble_y + bubble_height + 5
-            for i, option in enumerate(self.speech_options):
-                option_text = f"{i + 1}. {option['text']}"
-                option_surface = font.render(option_text, True, (0, 0, 0))  # Black text
-                option_bubble_width = option_surface.get_width() + 10
-                option_bubble_height = option_surface.get_height() + 10
-                option_bubble_x = bubble_x
-                option_bubble_y = option_y
-                pygame.draw.rect(screen, (255, 255, 255), (option_bubble_x, option_bubble_y, option_bubble_width, option_bubble_height))  # White background
-                pygame.draw.rect(screen, (0, 0, 0), (option_bubble_x, option_bubble_y, option_bubble_width, option_bubble_height), 2)  # Black border
-                screen.blit(option_surface, (option_bubble_x + 5, option_bubble_y + 5))
-                option_y += option_bubble_height + 5
+            drawn = screen.blit(bubble, (bubble_x, bubble_y))
 
             self.speech_timer -= 1
 
-        if not self.speech_options and self.current_dialog != self.start_dialog:
+        if not self.speech_options and self.current_node != self.dialog.start:
             if self.end_dialog_timer is None:
                 self.end_dialog_timer = 0
             self.end_dialog_timer += 1
             if self.end_dialog_timer >= self.end_dialog_duration:
-                self.current_dialog = self.start_dialog
-                self.current_options = self.start_dialog.get('options', [])
+                if self.next_dialog is not None:
+                    self.dialog, self.next_dialog = self.next_dialog, None
+                self.current_node = self.dialog.start
+                self.current_options = self.dialog.options(self.current_node)
                 self.talk(None)
+        return drawn
 
     def handle_input(self, key):
         if self.speech_options and self.speech_timer > 0:
             option_index = key - pygame.K_1
             if 0 <= option_index < len(self.speech_options):
                 selected_option = self.speech_options[option_index]
+                dialog = self.dialog
+                self.current_node = dialog.target(selected_option)
 
-                if 'options' not in selected_option:
-                    self.speech_options = []
-                    self.current_options = []
+                if not dialog.options(self.current_node):
+                    self.speech_options = ()
+                    self.current_options = ()
                     self.end_dialog_timer = None
-                    self.current_dialog = selected_option['response']
                 else:
                     self.speech_timer = self.speech_duration  # Reset the timer when a new dialog is set
 
-                    self.current_dialog = selected_option['response']
-                    self.current_options = selected_option['options']
+                    self.current_options = dialog.options(self.current_node)
                     self.talk(None)
 
-                    print(f"Selected Option: {selected_option['text']}")
-                    print(f"New dialog: {self.current_dialog['text']}")
+                    print(f"Selected Option: {dialog.option_label(selected_option)}")
+                    print(f"New dialog: {dialog.text(self.current_node)}")
                     for i, option in enumerate(self.current_options):
-                        print(f"New Option {i + 1}: {option['text']}")
+                        print(f"New Option {i + 1}: {dialog.option_label(option)}")
+
+    # Speech text and numbered options assembled into one surface. Returns
+    # (surface, width, height of the speech part) for draw_speech to place.
+    def render_bubble(self, font):
+        wrapped_text = self.wrap_text(self.speech_text, font, 500)
+        bubble_width = max(line.get_width() for line in wrapped_text) + 10
+        bubble_height = sum(line.get_height() for line in wrapped_text) + 10
+        option_surfaces = [
+            text_cache.render(font, f"{i + 1}. {self.dialog.option_label(option)}", (0, 0, 0))  # Black text
+            for i, option in enumerate(self.speech_options)
+        ]
+        width = max([bubble_width] + [option.get_width() + 10 for option in option_surfaces])
+        height = bubble_height + sum(option.get_height() + 15 for option in option_surfaces)
+        bubble = pygame.Surface((width, height), pygame.SRCALPHA)
+
+        pygame.draw.rect(bubble, (0, 0, 0), (0, 0, bubble_width, bubble_height))  # White background
+        pygame.draw.rect(bubble, (255, 255, 255), (0, 0, bubble_width, bubble_height), 2)  # Black border
+        text_y = 5
+        for line in wrapped_text:
+            bubble.blit(line, (5, text_y))
+            text_y += line.get_height()
+
+        option_y = bubble_height + 5
+        for option_surface in option_surfaces:
+            option_bubble_width = option_surface.get_width() + 10
+            option_bubble_height = option_surface.get_height() + 10
+            pygame.draw.rect(bubble, (255, 255, 255), (0, option_y, option_bubble_width, option_bubble_height))  # White background
+            pygame.draw.rect(bubble, (0, 0, 0), (0, option_y, option_bubble_width, option_bubble_height), 2)  # Black border
+            bubble.blit(option_surface, (5, option_y + 5))
+            option_y += option_bubble_height + 5
+        return bubble, bubble_width, bubble_height
 
     def wrap_text(self, text, font, max_width):
-        words = text.split(' ')
-        lines = []
-        current_line = []
-
-        for word in words:
-            current_line.append(word)
-            width, _ = font.size(' '.join(current_line))
-            if width > max_width:
-                current_line.pop()
-                lines.append(' '.join(current_line))
-                current_line = [word]
-
-        lines.append(' '.join(current_line))
-        return [font.render(line, True, (255, 255, 255)) for line in lines]
+        return text_cache.wrap(font, text, max_width, (255, 255, 255))
+
+# LRU cache of rendered text: single lines, wrapped paragraphs and whole
+# speech bubbles, keyed on the text, font, width and color that produced them
+class TextCache:
+    def __init__(self, max_entries=512):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.glyphs = {}  # (font, char, color) -> surface
+
+    def get(self, key, build):
+        value = self.entries.get(key)
+        if value is None:
+            value = self.entries[key] = build()
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        else:
+            self.entries.move_to_end(key)
+        return value
+
+    def render(self, font, text, color):
+        return self.get(('line', font, text, color), lambda: font.render(text, True, color))
+
+    # Greedy word wrap to max_width; returns one surface per line
+    def wrap(self, font, text, max_width, color):
+        def build():
+            lines = []
+            current_line = []
+            for word in text.split(' '):
+                current_line.append(word)
+                width, _ = font.size(' '.join(current_line))
+                if width > max_width:
+                    current_line.pop()
+                    lines.append(' '.join(current_line))
+                    current_line = [word]
+            lines.append(' '.join(current_line))
+            return [self.render(font, line, color) for line in lines]
+        return self.get(('wrap', font, text, max_width, color), build)
+
+    # Draw text that changes every frame (e.g. the clock) from cached glyphs
+    # instead of rendering a new surface; returns the covered rect
+    def draw_glyphs(self, screen, font, text, color, position):
+        x, y = position
+        blits = []
+        for char in text:
+            glyph = self.glyphs.get((font, char, color))
+            if glyph is None:
+                glyph = self.glyphs[(font, char, color)] = font.render(char, True, color)
+            blits.append((glyph, (x, y)))
+            x += glyph.get_width()
+        screen.blits(blits, doreturn=False)
+        return pygame.Rect(position[0], y, x - position[0], font.get_height())
+
+text_cache = TextCache()
 
 def draw_debug_info(screen, font, character, map_data):
     tile_x = character.x // TILE_SIZE
     tile_y = character.y // TILE_SIZE
     tile_id = map_data.map_data[tile_y][tile_x]
     debug_text = f'Tile X: {tile_x}, Tile Y: {tile_y}, Tile ID: {tile_id}'
-    text_surface = font.render(debug_text, True, (255, 255, 255))
-    screen.blit(text_surface, (SCREEN_WIDTH - text_surface.get_width() - 10, 10))
+    text_surface = text_cache.render(font, debug_text, (255, 255, 255))
+    return screen.blit(text_surface, (SCREEN_WIDTH - text_surface.get_width() - 10, 10))
 
 def draw_clock(screen, font, game_time):
     minutes = (game_time // 60) % 24
     seconds = game_time % 60
     time_str = f'{minutes:02}:{seconds:02}'
-    text_surface = font.render(time_str, True, (255, 255, 255))
-    screen.blit(text_surface, (10, 10))
-
-def draw_night_overlay(screen, alpha):
-    overlay = pygame.Surface((SCREEN_WIDTH, SCREEN_HEIGHT))
-    overlay.set_alpha(alpha)
-    overlay.fill(NIGHT_COLOR)
-    screen.blit(overlay, (0, 0))
+    return text_cache.draw_glyphs(screen, font, time_str, (255, 255, 255), (10, 10))
 
-def is_daytime(game_time):
-    return game_time % (2 * DAY_DURATION) < DAY_DURATION
-
-def main():
-    screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT), pygame.RESIZABLE)
-    pygame.display.set_caption("Barnyard Chaos")
-    clock = pygame.time.Clock()
-
-    # Initialize font
-    pygame.font.init()
-    font = pygame.font.SysFont('Arial', 18)
-
-    # Show loading screen
-    loading_screen(screen)
-
-    # Call the OpenAI API
-    dialog_tree_json = call_openai_api()
-
-    if dialog_tree_json:
-        try:
-            dialog_tree = json.loads(dialog_tree_json)
-        except json.JSONDecodeError:
-            print("Failed to decode JSON, using default dialog tree")
-            print(dialog_tree_json)
-            dialog_tree = default_dialog_tree
-    else:
-        dialog_tree = default_dialog_tree
+# Rolling per-phase timings, entity and allocation counts (toggle with F3)
+def draw_profiler_hud(screen, font, profiler):
+    if not profiler.history:
+        return None
+    sample = profiler.history[-1]
+    averages = profiler.averages()
+    total = sum(averages.values())
+    lines = [f'Frame: {total:.2f} ms ({1000 / total if total else 0:.0f} fps)']
+    for name, ms in sorted(averages.items(), key=lambda item: -item[1]):
+        lines.append(f'{name}: {ms:.2f} ms')
+    for name, count in sample['counts'].items():
+        lines.append(f'{name}: {count}')
+    delta = sum(s['allocated_delta'] for s in profiler.history) / len(profiler.history)
+    lines.append(f"Allocated blocks: {sample['allocated_blocks']} ({delta:+.0f}/frame)")
+
+    line_height = font.get_linesize()
+    panel = pygame.Surface((260, line_height * len(lines) + 10), pygame.SRCALPHA)
+    panel.fill((0, 0, 0, 160))
+    for i, line in enumerate(lines):
+        panel.blit(font.render(line, True, (255, 255, 255)), (5, 5 + i * line_height))
+    return screen.blit(panel, (10, 40))
+
+# Full-screen night tint, kept between frames and only rebuilt when the
+# window size changes. In lighting mode the darkness is per-pixel alpha and
+# each light cuts a soft hole in it using a cached radial gradient.
+class NightOverlay:
+    def __init__(self, lighting=False):
+        self.lighting = lighting
+        self.surface = None
+        self.surface_key = None  # (size, lighting) the surface was built for
+        self.gradients = {}  # radius -> light cutout surface
+
+    def get_surface(self, size):
+        if self.surface_key != (size, self.lighting):
+            self.surface_key = (size, self.lighting)
+            if self.lighting:
+                self.surface = pygame.Surface(size, pygame.SRCALPHA)
+            else:
+                self.surface = pygame.Surface(size)
+                self.surface.fill(NIGHT_COLOR)
+        return self.surface
+
+    # White surface whose alpha ramps from 0 at the center to 255 at radius,
+    # multiplied into the darkness to cut out a light
+    def get_gradient(self, radius):
+        gradient = self.gradients.get(radius)
+        if gradient is None:
+            gradient = pygame.Surface((radius * 2, radius * 2), pygame.SRCALPHA)
+            gradient.fill((255, 255, 255, 255))
+            for r in range(radius, 0, -2):
+                alpha = int(255 * (r / radius) ** 2)
+                pygame.draw.circle(gradient, (255, 255, 255, alpha), (radius, radius), r)
+            self.gradients[radius] = gradient
+        return gradient
+
+    # lights is a list of (screen_x, screen_y, radius), used in lighting mode
+    def draw(self, screen, alpha, lights=()):
+        if alpha <= 0:
+            return
+        overlay = self.get_surface(screen.get_size())
+        if self.lighting:
+            overlay.fill(NIGHT_COLOR + (alpha,))
+            for x, y, radius in lights:
+                overlay.blit(self.get_gradient(radius), (x - radius, y - radius), special_flags=pygame.BLEND_RGBA_MULT)
+        else:
+            overlay.set_alpha(alpha)
+        screen.blit(overlay, (0, 0))
 
-    game_map = Map('map.csv', tileset, default_tile)
-    blood_splat_frames = [blood_splat_tileset.subsurface(pygame.Rect(i * TILE_SIZE, 0, TILE_SIZE, TILE_SIZE)) for i in range(13)]
-    character = Character(character_tileset, character_sword, blood_splat_frames, 2000, 1500)
+night_overlay = NightOverlay()
 
-    # Load the cow tileset (4x4 tileset, 128px tiles)
-    cow_tile_size = 128
-    cow_speed = 1
-    cows = []
+def draw_night_overlay(screen, alpha, lights=()):
+    night_overlay.draw(screen, alpha, lights)
 
-    # Load the chicken tileset (4x4 tileset, 32px tiles)
-    chicken_tile_size = 32
-    chicken_speed = 1
-    chickens = []
+def is_daytime(game_time):
+    return game_time % (2 * DAY_DURATION) < DAY_DURATION
 
-    # Load the pig tileset (4x4 tileset, 128px tiles)
-    pig_tile_size = 128
-    pig_speed = 1
-    pigs = []
+# Sprite sheet, frame size, frame count and walking speed of each barnyard species
+SPECIES = {
+    'cow': {'kind': 0, 'tileset': 'cow_walk.png', 'tile_size': 128, 'frame_count': 4, 'speed': 1},  # 4x4 tileset, 128px tiles
+    'chicken': {'kind': 1, 'tileset': 'chicken_walk.png', 'tile_size': 32, 'frame_count': 4, 'speed': 1},  # 4x4 tileset, 32px tiles
+    'pig': {'kind': 2, 'tileset': 'pig_walk.png', 'tile_size': 128, 'frame_count': 4, 'speed': 1},  # 4x4 tileset, 128px tiles
+}
 
-    # Create some cows
-    for _ in range(5):
-        while True:
-            cow_x = random.randint(0, MAP_WIDTH * TILE_SIZE - cow_tile_size)
-            cow_y = random.randint(0, MAP_HEIGHT * TILE_SIZE - cow_tile_size)
-            if is_position_valid(cow_x, cow_y, cows, game_map):
-                cows.append(NPC(cow_x, cow_y, cow_tileset, cow_tile_size, 4, cow_speed, blood_splat_frames))
+# Every barnyard animal in a World. NPC objects are never thrown away: each
+# keeps its slot in entities for good. Once a dead NPC's blood splat has
+# finished, collect() takes it out of the species sets, the combined view
+# and the EntityStore and puts it in its species' free pool, from where the
+# next spawn resets and reuses it. A handle, (slot, generation), names one
+# life of an NPC, so a recycled NPC never passes for its previous life.
+class EntityManager:
+    def __init__(self, blood_splat_frames, store=None):
+        self.blood_splat_frames = blood_splat_frames
+        self.store = store
+        self.entities = []  # slot -> NPC
+        self.species = {species: {} for species in SPECIES}  # Live and dying NPCs (dicts as ordered sets)
+        self.npcs = {}  # Every species in one view, in spawn order
+        self.free = {species: [] for species in SPECIES}
+        self.dying = []  # Dead NPCs whose splat may still be running
+        self.spawned = dict.fromkeys(SPECIES, 0)
+
+    def __len__(self):
+        return len(self.npcs)
+
+    def __iter__(self):
+        return iter(self.npcs)
+
+    def acquire(self, species, x, y):
+        config = SPECIES[species]
+        free = self.free[species]
+        if free:
+            npc = free.pop()
+            npc.reset(x, y)
+        else:
+            npc = NPC(x, y, assets.image(config['tileset']), config['tile_size'], config['frame_count'], config['speed'], self.blood_splat_frames, self.store)
+            npc.species = species
+            npc.slot = len(self.entities)
+            npc.entities = self
+            self.entities.append(npc)
+        if self.store is not None:
+            self.store.kind[npc.index] = config['kind']
+        self.species[species][npc] = None
+        self.npcs[npc] = None
+        self.spawned[species] += 1
+        return npc
+
+    # Recycle the dead NPCs whose splat has finished; returns them
+    def collect(self):
+        released = [npc for npc in self.dying if not npc.show_blood_splat]
+        if not released:
+            return released
+        self.dying = [npc for npc in self.dying if npc.show_blood_splat]
+        for npc in released:
+            del self.species[npc.species][npc]
+            del self.npcs[npc]
+            if self.store is not None:
+                self.store.remove(npc.index)
+                npc.index = None
+            npc.generation += 1
+            self.free[npc.species].append(npc)
+        return released
+
+    # Move every NPC's state into store. Live and dying NPCs get a slot now;
+    # pooled ones get theirs when they are next reset.
+    def attach_store(self, store):
+        self.store = store
+        fields = [name for name, value in vars(NPC).items() if isinstance(value, StoreField)]
+        for npc in self.entities:
+            state = {name: npc.__dict__.pop(name) for name in fields}
+            npc.store = store
+            npc.index = None
+            if npc in self.npcs:
+                npc.index = store.add(npc)
+                for name, value in state.items():
+                    setattr(npc, name, value)
+                store.kind[npc.index] = SPECIES[npc.species]['kind']
+                store.scripted[npc.index] = bool(npc.path)
+
+# Key state used when the simulation runs without a keyboard
+IDLE_KEYS = defaultdict(bool)
+
+# World state and the fixed-timestep simulation step. Nothing here draws, so
+# a World can be stepped without a display.
+class World:
+    def __init__(self, dialog_tree=None, map_filename=MAP_FILENAME, cow_count=5, chicken_count=50, pig_count=10, vectorized=None, profiler=NULL_PROFILER, workers=0, lod=True):
+        self.profiler = profiler
+        profiler.start()
+        if dialog_tree is None:
+            dialog_tree = assets.dialog_tree()
+        # Barnyard animals live in an EntityStore and are stepped in bulk when
+        # NumPy is available and there are enough of them to pay for it. By
+        # default a World that starts small switches once spawning takes it
+        # past VECTORIZE_MIN_ANIMALS (see vectorize).
+        self.auto_vectorize = vectorized is None and np is not None
+        if vectorized is None:
+            vectorized = self.auto_vectorize and (cow_count + chicken_count + pig_count >= VECTORIZE_MIN_ANIMALS or workers > 1)
+        self.store = EntityStore(random.getrandbits(63)) if vectorized else None
+        self.use_lod = lod
+        tileset = assets.image(TILESET_FILENAME)
+        self.game_map = Map(map_filename, tileset, get_tile_image(tileset, DEFAULT_TILE_ID))
+        self.map_width = self.game_map.width * TILE_SIZE
+        self.map_height = self.game_map.height * TILE_SIZE
+        profiler.lap('map_load')
+        blood_splat_tileset = assets.image(BLOOD_SPLAT_FILENAME)
+        self.blood_splat_frames = [blood_splat_tileset.subsurface(pygame.Rect(i * TILE_SIZE, 0, TILE_SIZE, TILE_SIZE)) for i in range(13)]
+        get_blood_splat_animations(self.blood_splat_frames)
+        for rotation in get_blood_puddle_rotations(assets.image(BLOOD_PUDDLE_FILENAME), BLOOD_PUDDLE_SCALE):
+            get_decal_fades(rotation)
+        self.character = Character(assets.image(CHARACTER_FILENAME), assets.image(CHARACTER_SWORD_FILENAME), self.blood_splat_frames, 2000, 1500)
+
+        # Animals of each species, recycled as they die
+        self.entities = EntityManager(self.blood_splat_frames, self.store)
+        self.cows = self.entities.species['cow']
+        self.chickens = self.entities.species['chicken']
+        self.pigs = self.entities.species['pig']
+
+        # Spatial index shared by every NPC, kept up to date as they move
+        self.npc_index = SpatialHash()
+        # NPCs whose blood splat is still animating (dict as an ordered set)
+        self.splats = {}
+        self.chicken_index = PreyIndex()
+        self.pathfinder = Pathfinder(self.game_map)
+        # With more than one worker the store is stepped by a process pool
+        self.stepper = ShardedStepper(self.store, self.game_map, workers) if self.store is not None and workers > 1 else None
+        # Distant animals are stepped less often (see LodScheduler)
+        self.lod = LodScheduler() if self.store is not None and lod else None
+
+        # Create some cows, chickens and pigs
+        for species, count in (('cow', cow_count), ('chicken', chicken_count), ('pig', pig_count)):
+            if len(self.spawn_random(species, count)) < count:
+                print(f"No room left for another {species}")
+
+        # Create the evil wizard
+        wizard_tile_size = 48
+        self.evil_wizard = EvilWizard(1500, 1500, assets.image(WIZARD_FILENAME), wizard_tile_size, self.blood_splat_frames, dialog_tree)
+        self.npc_index.insert(self.evil_wizard)
+        self.evil_wizard.splats = self.splats
+
+        # Initialize game time
+        self.game_time = 0
+        self.ticks = 0
+        self.chicken_spawn_position = find_spawn_position(self.game_map, 'chicken')
+        profiler.lap('spawn')
+
+    @property
+    def days(self):
+        return self.ticks // (2 * DAY_DURATION)
+
+    # Place a new NPC at (x, y) if the spot is free; returns it or None
+    def spawn(self, species, x, y, fleeing=False):
+        if not is_position_valid(x, y, self.npc_index, self.game_map, SPECIES[species]['tile_size']):
+            return None
+        npc = self.entities.acquire(species, x, y)
+        npc.fleeing = fleeing
+        npc.splats = self.splats
+        self.npc_index.insert(npc)
+        if self.store is None and self.auto_vectorize and len(self.entities) >= VECTORIZE_MIN_ANIMALS:
+            self.vectorize()
+        return npc
+
+    # Move the animals into an EntityStore; from the next tick on they are
+    # stepped in bulk, with LOD. There is no way back, even if they die off.
+    def vectorize(self):
+        self.store = EntityStore(random.getrandbits(63))
+        self.entities.attach_store(self.store)
+        if self.use_lod:
+            self.lod = LodScheduler()
+
+    # Spawn up to count animals on free spots drawn from the map's spawn
+    # cells for the species' footprint; returns the NPCs placed. The cells
+    # are visited in a lazily shuffled order, so each draw is O(1) and a
+    # full map gives up after trying every cell once.
+    def spawn_random(self, species, count=1):
+        cells = self.game_map.spawn_cells(SPECIES[species]['tile_size'])
+        width = self.game_map.width
+        placed = []
+        swapped = {}
+        for i in range(len(cells)):
+            if len(placed) == count:
                 break
+            j = random.randrange(i, len(cells))
+            cell = cells[swapped.get(j, j)]
+            swapped[j] = swapped.get(i, i)
+            npc = self.spawn(species, (cell % width) * TILE_SIZE, (cell // width) * TILE_SIZE)
+            if npc is not None:
+                placed.append(npc)
+        return placed
+
+    # Advance the simulation by one 1/60 s tick
+    def step(self, keys=IDLE_KEYS):
+        profiler = self.profiler
+        character = self.character
+        game_map = self.game_map
+        character.update(keys, game_map)
+        character.update_attack(self.npc_index, game_map)
+        profiler.lap('character')
 
-    # Create some chickens
-    for _ in range(50):
-        while True:
-            chicken_x = random.randint(0, MAP_WIDTH * TILE_SIZE - chicken_tile_size)
-            chicken_y = random.randint(0, MAP_HEIGHT * TILE_SIZE - chicken_tile_size)
-            if is_position_valid(chicken_x, chicken_y, chickens, game_map):
-                chickens.append(NPC(chicken_x, chicken_y, chicken_tileset, chicken_tile_size, 4, chicken_speed, blood_splat_frames))
-                break
+        character_rect = pygame.Rect(character.x, character.y, character.width, character.height)
+        if self.store is not None:
+            self.step_store()
+        else:
+            for npc in self.entities:
+                npc.update(game_map, self.npc_index, character_rect, profiler)
+        profiler.lap('npc_update')
 
-    # Create some pigs
-    for _ in range(10):
-        while True:
-            pig_x = random.randint(0, MAP_WIDTH * TILE_SIZE - pig_tile_size)
-            pig_y = random.randint(0, MAP_HEIGHT * TILE_SIZE - pig_tile_size)
-            if is_position_valid(pig_x, pig_y, pigs, game_map):
-                pigs.append(NPC(pig_x, pig_y, pig_tileset, pig_tile_size, 4, pig_speed, blood_splat_frames))
-                break
+        # Make pigs chase and attack chickens
+        if is_daytime(self.game_time):
+            if self.store is not None:
+                store = self.store
+                n = store.count
+                self.chicken_index.rebuild_from_store(store, np.flatnonzero(store.alive[:n] & (store.kind[:n] == SPECIES['chicken']['kind'])))
+            else:
+                self.chicken_index.rebuild(self.chickens)
+            for pig in self.pigs:
+                pig.hunt(self.chicken_index, game_map, self.pathfinder)
+        profiler.lap('chase')
+        self.pathfinder.update()
+        profiler.lap('pathfinding')
 
-    # Create the evil wizard
-    wizard_tile_size = 48
-    evil_wizard = EvilWizard(1500, 1500, wizard_tileset, wizard_tile_size, blood_splat_frames, dialog_tree)
+        self.evil_wizard.update(game_map, self.npc_index, character_rect)
+
+        # Check if wizard is close to the player
+        if self.evil_wizard.is_player_close(character, 100):  # Example range of 100 pixels
+            self.evil_wizard.talk(character)
+        profiler.lap('wizard')
+
+        self.game_map.update_decals()
+        profiler.lap('decals')
+
+        # A fresh chicken appears at the spawn tile every morning
+        if is_daytime(self.game_time) and self.game_time % DAY_DURATION == 0 and self.chicken_spawn_position:
+            chicken_x, chicken_y = self.chicken_spawn_position
+            self.spawn('chicken', chicken_x, chicken_y + TILE_SIZE, fleeing=True)
+
+        # Dead animals go back to the pool once their splat is over
+        for npc in self.entities.collect():
+            self.pathfinder.cancel(npc)
+
+        self.game_time = (self.game_time + 1) % (2 * DAY_DURATION)
+        self.ticks += 1
+        profiler.lap('respawn')
+
+    # Vectorized NPC update: scripted NPCs (those following a path) take the
+    # per-object path, everyone else is moved by EntityStore.step
+    def step_store(self):
+        store = self.store
+        game_map = self.game_map
+        # The wizard isn't in the store; its own update advances its splat
+        for npc in list(self.splats):
+            if npc is not self.evil_wizard:
+                npc.update_blood_splat()
+
+        n = store.count
+        for index in np.flatnonzero(store.scripted[:n] & store.alive[:n]):
+            npc = store.npcs[index]
+            npc.update_movement(game_map, self.npc_index, self.profiler)
+            npc.update_animation()
+
+        old_x = store.x[:n].copy()
+        old_y = store.y[:n].copy()
+        wizard = self.evil_wizard
+        obstacles = [(wizard.x, wizard.y, wizard.tile_size)] if wizard.alive else []
+        mask = dt = collide = None
+        if self.lod is not None:
+            character = self.character
+            camera = pygame.Rect(character.offset_x, character.offset_y, SCREEN_WIDTH, SCREEN_HEIGHT)
+            mask, dt, collide = self.lod.schedule(store, camera, self.ticks)
+        (self.stepper or store).step(game_map, obstacles, self.profiler, mask, dt, collide)
+
+        # Re-bucket only the NPCs whose spatial hash cells changed
+        cell_size = self.npc_index.cell_size
+        size = store.tile_size[:n] - 1
+        old_x, old_y = np.trunc(old_x), np.trunc(old_y)
+        new_x, new_y = np.trunc(store.x[:n]), np.trunc(store.y[:n])
+        changed = ((old_x // cell_size != new_x // cell_size) | (old_y // cell_size != new_y // cell_size) |
+                   ((old_x + size) // cell_size != (new_x + size) // cell_size) |
+                   ((old_y + size) // cell_size != (new_y + size) // cell_size))
+        for index in np.flatnonzero(changed & store.alive[:n]):
+            self.npc_index.move(store.npcs[index])
+
+    # Stop the stepper's worker processes
+    def close(self):
+        if self.stepper is not None:
+            self.stepper.close()
+            self.stepper = None
+
+    def entity_counts(self):
+        counts = {
+            'cows': sum(npc.alive for npc in self.cows),
+            'chickens': sum(npc.alive for npc in self.chickens),
+            'pigs': sum(npc.alive for npc in self.pigs),
+            'chickens_spawned': self.entities.spawned['chicken'],
+        }
+        if self.lod is not None:
+            counts['lod_near'], counts['lod_mid'], counts['lod_far'] = self.lod.tier_counts
+        return counts
+
+    def summary(self):
+        summary = {'ticks': self.ticks, 'days': self.days}
+        summary.update(self.entity_counts())
+        return summary
+
+# Alpha of the night overlay at game_time; use night_alpha() which looks the
+# value up in a table precomputed over one day/night cycle
+def compute_night_alpha(game_time):
+    if game_time % (2 * DAY_DURATION) >= DAY_DURATION:
+        #night
+        if game_time % DAY_DURATION > DAY_DURATION - TRANSITION_DURATION:
+            #sunrise
+            return int(200 * (DAY_DURATION - (game_time % DAY_DURATION)) / TRANSITION_DURATION)
+        #print("night")
+        return 200
+    #daytime
+    if game_time % DAY_DURATION > DAY_DURATION - TRANSITION_DURATION:
+        #sunset
+        return int(200 * ((game_time % DAY_DURATION) - (DAY_DURATION - TRANSITION_DURATION)) / TRANSITION_DURATION)
+    #print("day")
+    return 0
+
+NIGHT_ALPHA_TABLE = bytes(compute_night_alpha(game_time) for game_time in range(2 * DAY_DURATION))
+
+def night_alpha(game_time):
+    return NIGHT_ALPHA_TABLE[game_time % (2 * DAY_DURATION)]
+
+# Draw the character, the NPCs in view and the running blood splats in one
+# Surface.blits call, back to front by the bottom edge of each sprite. NPCs
+# come from a spatial hash query of the camera rect, so the cost follows what
+# is on screen rather than the population.
+def visible_sprites(screen, world, offset_x, offset_y):
+    camera = pygame.Rect(offset_x, offset_y, screen.get_width(), screen.get_height())
+    character = world.character
+    image = character.image()
+    sprites = [(character.y + image.get_height(), 0, image, (character.x - offset_x, character.y - offset_y))]
+    for npc in world.npc_index.query(camera):
+        image = npc.image()
+        sprites.append((npc.y + image.get_height(), 0, image, (npc.x - offset_x, npc.y - offset_y)))
+    for npc in world.splats:
+        image, (x, y) = npc.blood_splat_sprite()
+        if camera.colliderect((x, y, image.get_width(), image.get_height())):
+            # Splats sit on top of the NPC they belong to
+            sprites.append((npc.y + npc.tile_size, 1, image, (x - offset_x, y - offset_y)))
+    sprites.sort(key=lambda sprite: (sprite[0], sprite[1]))
+    return [(image, position) for _, _, image, position in sprites]
+
+def draw_sprites(screen, world, offset_x, offset_y):
+    screen.blits(visible_sprites(screen, world, offset_x, offset_y), doreturn=False)
+
+def night_lights(world):
+    character = world.character
+    wizard = world.evil_wizard
+    return [
+        (character.x - character.offset_x + character.width // 2, character.y - character.offset_y + character.height // 2, 160),
+        (wizard.x - character.offset_x + wizard.tile_size // 2, wizard.y - character.offset_y + wizard.tile_size // 2, 96),
+    ]
+
+# Speech bubble, debug text, clock and (optionally) the profiler HUD, drawn
+# above the night overlay. Returns the screen rects they cover.
+def draw_ui(screen, font, world, game_time, hud=None):
+    character = world.character
+    rects = [
+        world.evil_wizard.draw_speech(screen, character.offset_x, character.offset_y, font),
+        draw_debug_info(screen, font, character, world.game_map),
+        draw_clock(screen, font, game_time),
+    ]
+    if hud is not None:
+        rects.append(draw_profiler_hud(screen, font, hud))
+    return [rect for rect in rects if rect is not None]
+
+def draw_world(screen, font, world, game_time, hud=None):
+    profiler = world.profiler
+    character = world.character
+    # Everything is redrawn, so pending map changes need no extra handling
+    world.game_map.take_changed_rects()
+    screen.fill((0, 0, 0))
+    world.game_map.draw(screen, character.offset_x, character.offset_y)
+    draw_sprites(screen, world, character.offset_x, character.offset_y)
+    profiler.lap('render')
+
+    # Apply night overlay if necessary
+    alpha = night_alpha(game_time)
+    draw_night_overlay(screen, alpha, night_lights(world) if alpha and night_overlay.lighting else ())
+    profiler.lap('overlay')
+
+    rects = draw_ui(screen, font, world, game_time, hud)
+    profiler.lap('ui')
+    return rects
+
+# Union overlapping rects (e.g. a sprite's old and new position) so the area
+# they share is only restored once
+def merge_rects(rects):
+    merged = []
+    for rect in rects:
+        if not rect:
+            continue
+        rect = rect.copy()
+        index = rect.collidelist(merged)
+        while index != -1:
+            rect.union_ip(merged.pop(index))
+            index = rect.collidelist(merged)
+        merged.append(rect)
+    return merged
+
+# Redraws only what changed since the last frame: the rects of sprites that
+# moved, appeared or vanished, map decals, and last frame's UI. Each dirty
+# rect is restored from the map and the sprites under it, then only those
+# rects are pushed with pygame.display.update. A camera scroll, a change in
+# night alpha, a resize or too many dirty rects fall back to a full redraw.
+class DirtyRectRenderer:
+    def __init__(self, max_rects=64):
+        self.max_rects = max_rects
+        self.state = None       # (screen size, camera offset, night alpha) of the last frame
+        self.sprites = set()    # (image, position) drawn last frame
+        self.ui_rects = []
+
+    def draw(self, screen, font, world, game_time, hud=None):
+        profiler = world.profiler
+        character = world.character
+        offset_x, offset_y = character.offset_x, character.offset_y
+        alpha = night_alpha(game_time)
+        state = (screen.get_size(), (offset_x, offset_y), alpha)
+        sprites = visible_sprites(screen, world, offset_x, offset_y)
+        drawn = set(sprites)
+
+        dirty = None
+        if state == self.state and not (alpha and night_overlay.lighting):
+            dirty = list(self.ui_rects)
+            for image, position in drawn.symmetric_difference(self.sprites):
+                dirty.append(pygame.Rect(position, image.get_size()))
+            for rect in world.game_map.take_changed_rects():
+                dirty.append(rect.move(-offset_x, -offset_y))
+            if len(dirty) > self.max_rects:
+                dirty = None
+        self.state = state
+        self.sprites = drawn
+
+        if dirty is None:
+            self.ui_rects = draw_world(screen, font, world, game_time, hud)
+            pygame.display.flip()
+            profiler.lap('flip')
+            return
 
-    # Initialize game time
-    game_time = 0
+        screen_rect = screen.get_rect()
+        dirty = merge_rects(rect.clip(screen_rect) for rect in dirty)
+        sprite_rects = [pygame.Rect(position, image.get_size()) for image, position in sprites]
+        for rect in dirty:
+            screen.set_clip(rect)
+            screen.fill((0, 0, 0))
+            world.game_map.draw(screen, offset_x, offset_y, rect)
+            screen.blits([sprites[i] for i in sorted(rect.collidelistall(sprite_rects))], doreturn=False)
+            night_overlay.draw(screen, alpha)
+        screen.set_clip(None)
+        profiler.lap('render')
+
+        self.ui_rects = draw_ui(screen, font, world, game_time, hud)
+        profiler.lap('ui')
+        pygame.display.update(dirty + self.ui_rects)
+        profiler.lap('flip')
+
+def main(profile_listeners=(), dirty_rects=False, workers=0, lod=True, startup_timing=False):
+    # Startup phases, including World's map_load and spawn
+    startup = Profiler()
+    pygame.init()
+    screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT), pygame.RESIZABLE)
+    pygame.display.set_caption("Barnyard Chaos")
+    clock = pygame.time.Clock()
 
-    chicken_spawn_position = find_tile_position(game_map, CHICKEN_SPAWN_TILE_ID)
+    # Initialize font
+    font = pygame.font.SysFont('Arial', 18)
+    loading_font = pygame.font.SysFont('Arial', 36)
+    startup.lap('display')
+
+    # Load the assets behind a progress bar
+    loading_screen(screen, loading_font, 0)
+    assets.load_all(lambda done, total, filename: loading_screen(screen, loading_font, done / total, f"Loading {filename}..."))
+    startup.lap('assets')
+    loading_screen(screen, loading_font, 1, "Building the barnyard...")
+
+    # Generate a dialog tree in the background and start with the default one
+    dialog_generator = DialogGenerator() if dialog_generation_enabled() else None
+    dialog_tree = assets.dialog_tree()
+
+    # Only time the frame while the HUD is up or something is listening
+    profiler = Profiler(enabled=bool(profile_listeners))
+    for listener in profile_listeners:
+        profiler.add_listener(listener)
+    show_profiler = False
+
+    world = World(dialog_tree, profiler=startup, workers=workers, lod=lod)
+    world.profiler = profiler
+    if startup_timing:
+        print(json.dumps(startup_report(startup)))
+    character = world.character
+    evil_wizard = world.evil_wizard
+    renderer = DirtyRectRenderer() if dirty_rects else None
 
     running = True
     while running:
+        profiler.start()
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
                 running = False
+            elif event.type == pygame.KEYDOWN and event.key == pygame.K_F3:
+                show_profiler = not show_profiler
+                profiler.enabled = show_profiler or bool(profiler.listeners)
+                profiler.start()
             elif event.type == pygame.MOUSEBUTTONDOWN and event.button == 3:
                 mouse_x, mouse_y = event.pos
-                chicken_x = mouse_x + character.offset_x
-                chicken_y = mouse_y + character.offset_y
-                if is_position_valid(chicken_x, chicken_y, chickens, game_map):
-                    chickens.append(NPC(chicken_x, chicken_y, chicken_tileset, chicken_tile_size, 4, chicken_speed, blood_splat_frames))
+                world.spawn('chicken', mouse_x + character.offset_x, mouse_y + character.offset_y)
             elif event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
                 character.attack()
             elif event.type == pygame.KEYDOWN and event.key == pygame.K_t:
                 evil_wizard.talk(character)  # Trigger wizard talk manually
+            elif event.type == pygame.KEYDOWN and event.key == pygame.K_l:
+                night_overlay.lighting = not night_overlay.lighting
             elif event.type == pygame.KEYDOWN and pygame.K_1 <= event.key <= pygame.K_9:
                 evil_wizard.handle_input(event.key)
 
-        keys = pygame.key.get_pressed()
-        character.update(keys, game_map)
-
-        screen.fill((0, 0, 0))
-        screen.blit(game_map.surface, (-character.offset_x, -character.offset_y))
-        character.draw(screen)
-        character.update_attack(cows + chickens + pigs + [evil_wizard], game_map.surface)
-
-        for npc_list in [cows, chickens, pigs]:
-            for npc in npc_list:
-                npc.update(game_map, cows + chickens + pigs + [evil_wizard], pygame.Rect(character.x, character.y, character.width, character.height))
-                npc.draw(screen, character.offset_x, character.offset_y)
-
-        # Make pigs chase and attack chickens
-        if is_daytime(game_time):
-            for pig in pigs:
-                if pig.alive:
-                    closest_chicken = None
-                    closest_distance = float('inf')
-                    for chicken in chickens:
-                        if chicken.alive:
-                            distance = ((pig.x - chicken.x) ** 2 + (pig.y - chicken.y) ** 2) ** 0.5
-                            if distance < closest_distance:
-                                closest_distance = distance
-                                closest_chicken = chicken
-                    if closest_chicken and closest_distance < 200:
-                        pig.chase(closest_chicken, game_map.surface)
-
-        evil_wizard.update(game_map, cows + chickens + pigs, pygame.Rect(character.x, character.y, character.width, character.height))
-        evil_wizard.draw(screen, character.offset_x, character.offset_y, font)
-
-        # Check if wizard is close to the player
-        if evil_wizard.is_player_close(character, 100):  # Example range of 100 pixels
-            evil_wizard.talk(character)
-
-        draw_debug_info(screen, font, character, game_map)
-        draw_clock(screen, font, game_time)
-
-        # Apply night overlay if necessary
-        if game_time % (2 * DAY_DURATION) >= DAY_DURATION:
-            #night
-            if game_time % DAY_DURATION > DAY_DURATION - TRANSITION_DURATION:
-                #sunrise
-                alpha = int(200 * (DAY_DURATION - (game_time % DAY_DURATION)) / TRANSITION_DURATION)
-            else:
-                #print("night")
-                alpha = 200
-            draw_night_overlay(screen, alpha)
+        if dialog_generator is not None:
+            generated_tree = dialog_generator.poll()
+            if generated_tree is not None:
+                evil_wizard.set_dialog_tree(generated_tree)
+        profiler.lap('events')
+
+        game_time = world.game_time
+        world.step(pygame.key.get_pressed())
+        hud = profiler if show_profiler else None
+        if renderer is not None:
+            renderer.draw(screen, font, world, game_time, hud)
         else:
-            #daytime
-            if game_time % DAY_DURATION > DAY_DURATION - TRANSITION_DURATION:
-                #sunset
-                alpha = int(200 * ((game_time % DAY_DURATION) - (DAY_DURATION - TRANSITION_DURATION)) / TRANSITION_DURATION)
-            else:
-                #print("day")
-                alpha = 0
-            draw_night_overlay(screen, alpha)
-
-
-        if is_daytime(game_time) and game_time % DAY_DURATION == 0 and chicken_spawn_position:
-            chicken_x, chicken_y = chicken_spawn_position
-            chicken_y += TILE_SIZE
-            if is_position_valid(chicken_x, chicken_y, chickens, game_map):
-                for _ in range(1):
-                    chicken = NPC(chicken_x, chicken_y, chicken_tileset, chicken_tile_size, 4, chicken_speed, blood_splat_frames)
-                    chicken.fleeing = True
-                    chickens.append(chicken)
-    
-
-        pygame.display.flip()
+            draw_world(screen, font, world, game_time, hud)
+            pygame.display.flip()
+            profiler.lap('flip')
+        if profiler.enabled:
+            profiler.end_frame(world.entity_counts())
         clock.tick(60)
-        game_time = (game_time + 1) % (2 * DAY_DURATION)
+
+    for listener in profile_listeners:
+        listener.close()
+    if dialog_generator is not None:
+        dialog_generator.shutdown()
+    world.close()
 
     pygame.quit()
 
+# Milliseconds spent in each startup phase and loading each asset file
+def startup_report(profiler):
+    return {
+        'phases_ms': {phase: round(total * 1000, 3) for phase, total in profiler.totals.items()},
+        'total_ms': round(sum(profiler.totals.values()) * 1000, 3),
+        'assets_ms': {filename: round(seconds * 1000, 3) for filename, seconds in assets.timings.items()},
+    }
+
+# Step a World as fast as possible with SDL's dummy video driver and no
+# drawing, e.g. to tune balance over many in-game days
+def run_headless(days, seed=None, **world_options):
+    os.environ['SDL_VIDEODRIVER'] = 'dummy'
+    pygame.display.quit()
+    pygame.display.init()
+    if seed is not None:
+        random.seed(seed)
+    world = World(**world_options)
+    for _ in range(days * 2 * DAY_DURATION):
+        world.step()
+    return world
+
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description="Barnyard Chaos")
+    parser.add_argument('--headless', action='store_true', help="run the simulation without a display")
+    parser.add_argument('--days', type=int, default=1, help="in-game days to simulate in headless mode")
+    parser.add_argument('--seed', type=int, default=None, help="random seed")
+    parser.add_argument('--dirty-rects', action='store_true', help="only redraw the parts of the screen that changed")
+    parser.add_argument('--profile-log', help="append per-frame profiler samples to this file as JSON lines")
+    parser.add_argument('--profile-port', type=int, help="send per-frame profiler samples as UDP datagrams to this local port")
+    parser.add_argument('--workers', type=int, default=0, help="step the barnyard animals in this many processes")
+    parser.add_argument('--no-lod', dest='lod', action='store_false', help="step every animal every frame, however far away")
+    parser.add_argument('--startup-timing', action='store_true', help="print how long each startup phase and asset took as JSON")
+    args = parser.parse_args()
+    if args.headless:
+        start_time = time.perf_counter()
+        world = run_headless(args.days, args.seed, workers=args.workers, lod=args.lod)
+        world.close()
+        summary = world.summary()
+        summary['seconds'] = round(time.perf_counter() - start_time, 3)
+        print(json.dumps(summary))
+    else:
+        if args.seed is not None:
+            random.seed(args.seed)
+        profile_listeners = []
+        if args.profile_log:
+            profile_listeners.append(ProfileFileSink(args.profile_log))
+        if args.profile_port:
+            profile_listeners.append(ProfileSocketSink(port=args.profile_port))
+        main(profile_listeners, args.dirty_rects, args.workers, args.lod, args.startup_timing)